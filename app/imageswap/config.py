@@ -12,9 +12,212 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import glob
+import math
+import os
+
+# Serve the Flask app (WSGI) or the event loop based app (ASGI)
+imageswap_server_mode = os.getenv("IMAGESWAP_SERVER_MODE", "WSGI").upper()
+
+# Import the app and compile the maps once in the gunicorn master, then fork the workers from it
+imageswap_preload = os.getenv("IMAGESWAP_PRELOAD", "FALSE").upper() == "TRUE"
+
+# Shared directory for multiprocess Prometheus metrics (optional)
+prometheus_multiproc_dir = os.getenv("PROMETHEUS_MULTIPROC_DIR", "")
+
+# Worker topology overrides, sized from the container's cgroup limits when unset
+imageswap_workers = os.getenv("IMAGESWAP_WORKERS", "")
+imageswap_threads = os.getenv("IMAGESWAP_THREADS", "")
+
+# Rough resident memory of a single worker, used to avoid sizing more workers than fit in the memory limit
+worker_memory_bytes = 96 * 1024 * 1024
+
+# Rough memory of each thread added to a worker (stack and an in-flight request), and the most threads to run per worker
+thread_memory_bytes = 8 * 1024 * 1024
+max_threads = 8
+
+
+def read_cgroup_file(cgroup_root, *path):
+
+    """Function to return the stripped contents of a cgroup file, or None if it doesn't exist"""
+
+    try:
+        with open(os.path.join(cgroup_root, *path)) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def cgroup_cpu_limit(cgroup_root="/sys/fs/cgroup"):
+
+    """Function to return the CPU limit of the container from its cgroup (v2 or v1), or None if it is unlimited"""
+
+    # cgroup v2: "<quota> <period>" or "max <period>"
+    cpu_max = read_cgroup_file(cgroup_root, "cpu.max")
+
+    if cpu_max is not None:
+        (quota, period) = cpu_max.split()[:2]
+        if quota == "max":
+            return None
+        return int(quota) / int(period)
+
+    # cgroup v1: a quota of -1 means unlimited
+    for cpu_dir in ["cpu", "cpu,cpuacct"]:
+        quota = read_cgroup_file(cgroup_root, cpu_dir, "cpu.cfs_quota_us")
+        period = read_cgroup_file(cgroup_root, cpu_dir, "cpu.cfs_period_us")
+        if quota is not None and period is not None:
+            if int(quota) <= 0:
+                return None
+            return int(quota) / int(period)
+
+    return None
+
+
+def cgroup_memory_limit(cgroup_root="/sys/fs/cgroup"):
+
+    """Function to return the memory limit of the container in bytes from its cgroup (v2 or v1), or None if it is unlimited"""
+
+    memory_max = read_cgroup_file(cgroup_root, "memory.max")
+
+    if memory_max is None:
+        memory_max = read_cgroup_file(cgroup_root, "memory", "memory.limit_in_bytes")
+
+    if memory_max is None or memory_max == "max":
+        return None
+
+    # cgroup v1 reports "unlimited" as a page aligned huge number
+    if int(memory_max) >= 2**60:
+        return None
+
+    return int(memory_max)
+
+
+def available_cpus():
+
+    """Function to return the number of CPUs the process is allowed to run on"""
+
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+
+    return os.cpu_count() or 1
+
+
+def parse_override(name, value):
+
+    """Function to parse a worker topology override, which must be a whole number of at least 1"""
+
+    try:
+        count = int(value)
+    except ValueError:
+        count = 0
+
+    if count < 1:
+        raise ValueError(f'{name} must be a whole number of at least 1, not "{value}"')
+
+    return count
+
+
+def worker_topology(cpu_limit, memory_limit, cpus, workers_override="", threads_override=""):
+
+    """Function to return the (workers, threads) to run for the given CPU and memory limits
+
+    Requests are CPU bound, so there is one worker per CPU of the quota (rounded,
+    never more than the CPUs available). Workers are capped by how many fit in the
+    memory limit next to the master.
+
+    Each worker runs two threads to overlap request I/O, plus more when a worker
+    has more than its share of requests in flight: below one CPU the quota is
+    throttled and every request takes 1 / quota times longer, and when the memory
+    limit caps the workers each one serves the requests of the CPUs that got no
+    worker. Threads are capped by max_threads and by the memory left over for them.
+    """
+
+    cpu_limit = cpus if cpu_limit is None else min(cpu_limit, cpus)
+
+    workers = max(1, min(round(cpu_limit), cpus))
+
+    if memory_limit is not None:
+        workers = max(1, min(workers, memory_limit // worker_memory_bytes - 1))
+
+    if workers_override:
+        workers = parse_override("IMAGESWAP_WORKERS", workers_override)
+
+    threads = min(max_threads, math.ceil(2 * max(1, cpu_limit / workers, 1 / cpu_limit)))
+
+    if memory_limit is not None:
+        spare_memory = memory_limit - (workers + 1) * worker_memory_bytes
+        threads = max(2, min(threads, 2 + spare_memory // (workers * thread_memory_bytes)))
+
+    if threads_override:
+        threads = parse_override("IMAGESWAP_THREADS", threads_override)
+
+    return (workers, threads)
+
+
+cpu_limit = cgroup_cpu_limit()
+memory_limit = cgroup_memory_limit()
+
 # Gunicorn config
 bind = ":5000"
-workers = 2
-threads = 2
+(workers, threads) = worker_topology(cpu_limit, memory_limit, available_cpus(), imageswap_workers, imageswap_threads)
+preload_app = imageswap_preload
 certfile = "/tls/cert.pem"
 keyfile = "/tls/key.pem"
+
+if imageswap_server_mode == "ASGI":
+    # uvicorn is installed from the Pipfile
+    wsgi_app = "imageswap_asgi:app"
+    worker_class = "uvicorn.workers.UvicornWorker"
+else:
+    wsgi_app = "imageswap:app"
+
+
+def when_ready(server):
+
+    """Gunicorn hook to log the worker topology once the server is ready, and watch the map file in a preloaded master"""
+
+    server.log.info(
+        f"ImageSwap topology: {workers} workers x {threads} threads "
+        f"(CPU limit: {cpu_limit if cpu_limit is not None else 'none'}, "
+        f"memory limit: {memory_limit if memory_limit is not None else 'none'}, "
+        f"CPUs available: {available_cpus()}, preload: {preload_app})"
+    )
+
+    if preload_app:
+        import imageswap
+
+        imageswap.start_master_maps_watcher()
+
+
+def post_worker_init(worker):
+
+    """Gunicorn hook to start the map file watcher in each worker process
+
+    This is a no-op in workers forked from a preloaded master, which watches the map file itself.
+    """
+
+    import imageswap
+
+    imageswap.start_maps_watcher()
+
+
+def on_starting(server):
+
+    """Gunicorn hook to remove metric files left behind by a previous run of the server"""
+
+    if prometheus_multiproc_dir:
+        # A preloaded master has already created its own metric files (ie. "gauge_max_<pid>.db")
+        own_suffix = f"_{os.getpid()}.db"
+        for metric_file in glob.glob(os.path.join(prometheus_multiproc_dir, "*.db")):
+            if not metric_file.endswith(own_suffix):
+                os.remove(metric_file)
+
+
+def child_exit(server, worker):
+
+    """Gunicorn hook to mark the metrics of an exited worker process as dead"""
+
+    if prometheus_multiproc_dir:
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
@@ -15,19 +15,39 @@
 # limitations under the License.
 
 from typing import IO
-from flask import Flask, request, jsonify
-from logging.handlers import MemoryHandler
-from prometheus_client import Counter
+from flask import Flask, Response, request, jsonify
+from flask.logging import wsgi_errors_stream
+from logging.handlers import QueueHandler, QueueListener
+from prometheus_client import Counter, Histogram
 from prometheus_flask_exporter import PrometheusMetrics
+from prometheus_flask_exporter.multiprocess import GunicornInternalPrometheusMetrics
+import atexit
 import base64
-import copy
+import collections
+import ctypes
 import datetime
 import json
-import jsonpatch
 import logging
 import os
+import queue
+import random
 import re
 import fnmatch
+import functools
+import hashlib
+import itertools
+import select
+import signal
+import threading
+import time
+
+# orjson is optional, but is used to decode and encode AdmissionReviews when available
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+import profiling
 
 app = Flask(__name__)
 
@@ -37,22 +57,198 @@ imageswap_pod_name = os.getenv("IMAGESWAP_POD_NAME")
 imageswap_disable_label = os.getenv("IMAGESWAP_DISABLE_LABEL", "k8s.twr.io/imageswap")
 imageswap_mode = os.getenv("IMAGESWAP_MODE", "MAPS")
 imageswap_maps_file = os.getenv("IMAGESWAP_MAPS_FILE", "/app/maps/imageswap-maps.conf")
+imageswap_maps_overlay_dir = os.getenv("IMAGESWAP_MAPS_OVERLAY_DIR", "")
+imageswap_maps_check_interval = float(os.getenv("IMAGESWAP_MAPS_CHECK_INTERVAL", "1"))
+imageswap_maps_watch = os.getenv("IMAGESWAP_MAPS_WATCH", "TRUE").upper() == "TRUE"
+imageswap_maps_watch_interval = float(os.getenv("IMAGESWAP_MAPS_WATCH_INTERVAL", "5"))
+imageswap_decision_cache_size = int(os.getenv("IMAGESWAP_DECISION_CACHE_SIZE", "1024"))
+imageswap_decision_cache_ttl = float(os.getenv("IMAGESWAP_DECISION_CACHE_TTL", "0"))
+imageswap_response_cache_size = int(os.getenv("IMAGESWAP_RESPONSE_CACHE_SIZE", "0"))
+imageswap_json_backend = os.getenv("IMAGESWAP_JSON_BACKEND", "auto")
+imageswap_log_queue_size = int(os.getenv("IMAGESWAP_LOG_QUEUE_SIZE", "10000"))
+imageswap_audit_sample_rate = float(os.getenv("IMAGESWAP_AUDIT_SAMPLE_RATE", "1"))
+prometheus_multiproc_dir = os.getenv("PROMETHEUS_MULTIPROC_DIR", "")
 imageswap_maps_default_key = "default"
 imageswap_maps_wildcard_key = "noswap_wildcards"
+imageswap_maps_namespaces_key = "namespaces"
+imageswap_maps_selector_key = "selector"
 imageswap_exact_keyword = "[EXACT]"
 imageswap_replace_keyword = "[REPLACE]"
 
-# Setup Prometheus Metrics for Flask app
-metrics = PrometheusMetrics(app, defaults_prefix="imageswap")
+# Setup Prometheus Metrics for Flask app. With a shared metrics directory every gunicorn
+# worker writes its metrics to files there and a scrape of any worker aggregates them all.
+if prometheus_multiproc_dir:
+    metrics = GunicornInternalPrometheusMetrics(app, defaults_prefix="imageswap")
+else:
+    metrics = PrometheusMetrics(app, defaults_prefix="imageswap")
 
 # Static information as metric
 metrics.info("app_info", "Application info", version="v1.2.0")
 
+# Image swap decision cache metrics
+decision_cache_hits = Counter("imageswap_decision_cache_hits", "Number of image swap decisions served from the cache")
+decision_cache_misses = Counter("imageswap_decision_cache_misses", "Number of image swap decisions not found in the cache")
+decision_cache_evictions = Counter("imageswap_decision_cache_evictions", "Number of image swap decisions evicted from the cache")
+
+# Admission response cache metrics
+response_cache_hits = Counter("imageswap_response_cache_hits", "Number of admission responses served from the cache")
+response_cache_misses = Counter("imageswap_response_cache_misses", "Number of admission responses not found in the cache")
+response_cache_evictions = Counter("imageswap_response_cache_evictions", "Number of admission responses evicted from the cache")
+
+# Admission pipeline metrics, one series per phase so slow requests can be traced
+# to decoding, map loading, swapping, patch generation or encoding. The "swap"
+# phase is observed once per container.
+admission_phase_seconds = Histogram(
+    "imageswap_admission_phase_seconds",
+    "Time spent in each phase of an AdmissionReview in seconds",
+    ["phase", "kind", "outcome"],
+    buckets=(0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0),
+)
+
+# Logging metrics
+log_records_dropped = Counter("imageswap_log_records_dropped", "Number of log records dropped because the log queue was full")
+
 # Set logging config
 log = logging.getLogger("werkzeug")
 log.disabled = True
 imageswap_log_level = os.getenv("IMAGESWAP_LOG_LEVEL", "INFO")
 app.logger.setLevel(imageswap_log_level)
+# The audit log has its own level, so raising IMAGESWAP_LOG_LEVEL doesn't turn it off
+imageswap_audit_log_level = os.getenv("IMAGESWAP_AUDIT_LOG_LEVEL", "INFO")
+
+# One JSON audit record is logged per admission. The records are written without the
+# usual log prefix so every line can be parsed as JSON.
+audit_logger = app.logger.getChild("audit")
+audit_logger.propagate = False
+audit_logger.setLevel(imageswap_audit_log_level)
+audit_handler = logging.StreamHandler(wsgi_errors_stream)
+audit_handler.setFormatter(logging.Formatter("%(message)s"))
+audit_logger.addHandler(audit_handler)
+
+
+class DroppingQueueHandler(QueueHandler):
+
+    """Class to hand log records to a background writer without ever blocking the calling thread"""
+
+    def enqueue(self, record):
+
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            log_records_dropped.inc()
+
+
+class LogListener(QueueListener):
+
+    """Class to write queued log records to the original handlers of their logger from a background thread"""
+
+    def __init__(self, log_queue, routes):
+
+        super().__init__(log_queue, respect_handler_level=True)
+        # Logger name -> handlers, records of child loggers use the handlers of their closest parent
+        self.routes = routes
+
+    def handle(self, record):
+
+        name = record.name
+        while name not in self.routes and "." in name:
+            name = name.rsplit(".", 1)[0]
+
+        for handler in self.routes.get(name, ()):
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def enqueue_sentinel(self):
+
+        # The queue may be full, wait for the writer to make room instead of failing to stop
+        self.queue.put(self._sentinel, timeout=5)
+
+
+_log_listener = None
+_log_queue_handler = None
+
+
+def start_queued_logging(loggers, maxsize):
+
+    """Function to move the handlers of loggers behind a bounded queue drained by a background thread
+
+    Log records are formatted on the calling thread, but the (possibly slow) writes
+    to stderr happen on the writer thread. When the queue is full new records are
+    dropped and counted instead of stalling requests.
+    """
+
+    global _log_listener, _log_queue_handler
+
+    if maxsize <= 0:
+        return None
+
+    if _log_queue_handler is None:
+        _log_queue_handler = DroppingQueueHandler(None)
+        routes = {}
+        for logger in loggers:
+            routes[logger.name] = [handler for handler in logger.handlers if not isinstance(handler, QueueHandler)]
+            for handler in routes[logger.name]:
+                logger.removeHandler(handler)
+            logger.addHandler(_log_queue_handler)
+    else:
+        routes = _log_listener.routes
+
+    # A new queue is used every time, the queue of a parent process may have been locked when it forked
+    _log_queue_handler.queue = queue.Queue(maxsize)
+    _log_listener = LogListener(_log_queue_handler.queue, routes)
+    _log_listener.start()
+
+    return _log_listener
+
+
+def stop_queued_logging():
+
+    """Function to write any queued log records and stop the background writer"""
+
+    if _log_listener is not None and _log_listener._thread is not None:
+        try:
+            _log_listener.stop()
+        except queue.Full:
+            pass
+
+
+def _restart_queued_logging():
+
+    """Function to restart the background log writer in a forked child, threads don't survive a fork"""
+
+    if _log_listener is not None:
+        start_queued_logging([], imageswap_log_queue_size)
+
+
+start_queued_logging([app.logger, audit_logger], imageswap_log_queue_size)
+os.register_at_fork(after_in_child=_restart_queued_logging)
+atexit.register(stop_queued_logging)
+
+
+################################################################################
+################################################################################
+################################################################################
+
+
+# JSON backend used for AdmissionReview bodies. "loads" accepts bytes and "dumps"
+# returns bytes, matching the orjson interface.
+JsonBackend = collections.namedtuple("JsonBackend", ["name", "loads", "dumps"])
+
+
+def load_json_backend(name):
+
+    """Function to return the JSON backend to use for AdmissionReview bodies"""
+
+    if name.lower() in ("auto", "orjson") and orjson is not None:
+        return JsonBackend("orjson", orjson.loads, orjson.dumps)
+
+    if name.lower() == "orjson":
+        app.logger.warning('The "orjson" JSON backend is not installed, falling back to the "json" backend')
+
+    return JsonBackend("json", json.loads, lambda obj: json.dumps(obj).encode())
+
+
+json_backend = load_json_backend(imageswap_json_backend)
 
 ################################################################################
 ################################################################################
@@ -64,115 +260,286 @@ def mutate():
 
     """Function to run main logic to handle imageswap mutation"""
 
-    request_info = request.json
-    modified_spec = copy.deepcopy(request_info)
-    uid = modified_spec["request"]["uid"]
-    workload_metadata = modified_spec["request"]["object"]["metadata"]
-    workload_type = modified_spec["request"]["kind"]["kind"]
-    namespace = modified_spec["request"]["namespace"]
-    # flag, whether there was at least one change, so that a patch has to be returned
-    needs_patch = False
+    (status, response_body, content_type) = review_admission(request.get_data(cache=False))
 
-    app.logger.info("##################################################################")
+    return Response(response_body, status=status, content_type=content_type)
 
-    # Detect if "name" in object metadata
-    # this was added because the request object for pods doesn't
-    # include a "name" field in the object metadata. This is because generateName
-    # occurs Server Side post-admission
-    if "name" in workload_metadata:
 
-        workload = modified_spec["request"]["object"]["metadata"]["name"]
+def review_admission(request_body):
 
-    elif "generateName" in workload_metadata:
+    """Function to review a raw AdmissionReview request body and return the (status, body, content type) of the response
 
-        workload = modified_spec["request"]["object"]["metadata"]["generateName"]
+    This is shared by the WSGI and ASGI servers.
+    """
 
-    else:
+    return profiling.run_admission(admit, request_body)
 
-        workload = uid
 
-    app.logger.debug(json.dumps(request.json))
+def admit(request_body):
 
-    # Skip patching if disable label is found and set to "disable"
-    if (
-        "labels" in workload_metadata
-        and imageswap_disable_label in workload_metadata["labels"]
-        and workload_metadata["labels"][imageswap_disable_label] == "disabled"
-    ):
+    """Function to run the admission pipeline for a raw AdmissionReview request body"""
 
-        app.logger.info(f'Disable label "{imageswap_disable_label}=disabled" detected for "{workload}" {workload_type}", skipping image swap.')
-        needs_patch = False
+    admission_start = phase_start = time.perf_counter()
 
-    else:
+    try:
+        request_info = json_backend.loads(request_body)
+    except ValueError as e:
+        app.logger.error(f"Unable to decode AdmissionReview request: {e}")
+        observe_phases({"decode": time.perf_counter() - phase_start}, [], "unknown", "invalid")
+        return (400, b"Invalid AdmissionReview request", "text/plain")
 
-        # Change workflow/json path based on K8s object type
-        if workload_type == "Pod":
+    uid = request_info["request"]["uid"]
+    workload_object = request_info["request"]["object"]
+    workload_metadata = workload_object["metadata"]
+    workload_type = request_info["request"]["kind"]["kind"]
+    namespace = request_info["request"]["namespace"]
 
-            for container_spec in modified_spec["request"]["object"]["spec"]["containers"]:
+    phases = {"decode": time.perf_counter() - phase_start}
+    swap_times = []
+    audit = {"uid": uid, "namespace": namespace, "workload": workload_name(workload_metadata, uid), "kind": workload_type}
 
-                app.logger.info(f"Processing container: {namespace}/{workload}")
-                needs_patch = swap_image(container_spec) or needs_patch
+    # Log the raw request body instead of serializing the request again
+    if app.logger.isEnabledFor(logging.DEBUG):
+        app.logger.debug(request_body.decode())
 
-            if "initContainers" in modified_spec["request"]["object"]["spec"]:
+    # Skip patching if disable label is found and set to "disable". This is checked
+    # before anything else so opted out workloads cost as little as possible.
+    workload_labels = workload_metadata.get("labels") or {}
 
-                for init_container_spec in modified_spec["request"]["object"]["spec"]["initContainers"]:
+    if workload_labels.get(imageswap_disable_label) == "disabled":
 
-                    app.logger.info(f"Processing init-container: {namespace}/{workload}")
-                    needs_patch = swap_image(init_container_spec) or needs_patch
+        return complete_admission(admission_review(uid), phases, swap_times, audit, [], "disabled", admission_start)
 
-        else:
+    # Load the maps once so every container in the request is evaluated against the same version
+    phase_start = time.perf_counter()
+    compiled_maps = overlay_swap_maps(get_swap_maps(imageswap_maps_file), namespace, workload_labels) if imageswap_mode.lower() == "maps" else None
+    phases["maps"] = time.perf_counter() - phase_start
 
-            for container_spec in modified_spec["request"]["object"]["spec"]["template"]["spec"]["containers"]:
+    # Pre-scan every image so requests with nothing to swap return before any
+    # per-container processing. Decisions are reused to build the patch.
+    containers = locate_containers(workload_object, workload_type)
 
-                app.logger.info(f"Processing container: {namespace}/{workload}")
-                needs_patch = swap_image(container_spec) or needs_patch
+    # Replicas of a workload are admitted with identical images, so with the response
+    # cache enabled only the first replica is evaluated and the rest reuse its patch
+    cache_key = None
 
-            if "initContainers" in modified_spec["request"]["object"]["spec"]["template"]["spec"]:
+    if compiled_maps is not None and response_cache.maxsize > 0:
+        phase_start = time.perf_counter()
+        cache_key = response_cache_key(workload_type, containers, workload_labels.get(imageswap_disable_label))
+        cached = response_cache.get(compiled_maps.version, cache_key)
+        phases["cache"] = time.perf_counter() - phase_start
 
-                for init_container_spec in modified_spec["request"]["object"]["spec"]["template"]["spec"]["initContainers"]:
+        if cached is not None:
+            (decisions, patch_json) = cached
+            return complete_admission(
+                admission_review(uid, patch_json), phases, swap_times, audit, decisions, "patched" if patch_json else "unchanged", admission_start
+            )
 
-                    app.logger.info(f"Processing init-container: {namespace}/{workload}")
-                    needs_patch = swap_image(init_container_spec) or needs_patch
+    decisions = []
 
-    if needs_patch:
+    for (image_path, container_spec) in containers:
+        phase_start = time.perf_counter()
+        decisions.append((image_path, evaluate_container(container_spec, compiled_maps)))
+        swap_times.append(time.perf_counter() - phase_start)
 
-        app.logger.debug("Needs patch")
-        app.logger.info("Diffing original request to modified request and generating JSONPatch")
+    # JSONPatch operations for each swapped image. The request itself is never
+    # modified, so there is no need to copy and diff the whole object.
+    phase_start = time.perf_counter()
+    patch = patch_images(decisions)
 
-        patch = jsonpatch.JsonPatch.from_diff(request_info["request"]["object"], modified_spec["request"]["object"])
+    if not patch:
 
-        app.logger.debug(f"JSON Patch: {patch}")
+        app.logger.debug("Doesn't need patch")
+        phases["patch"] = time.perf_counter() - phase_start
 
-        admission_response = {
-            "allowed": True,
-            "uid": request_info["request"]["uid"],
-            "patch": base64.b64encode(str(patch).encode()).decode(),
-            "patchType": "JSONPatch",
-        }
-        admissionReview = {
-            "apiVersion": "admission.k8s.io/v1",
-            "kind": "AdmissionReview",
-            "response": admission_response,
-        }
+        if cache_key is not None:
+            response_cache.put(compiled_maps.version, cache_key, (decisions, None))
 
-    else:
+        return complete_admission(admission_review(uid), phases, swap_times, audit, decisions, "unchanged", admission_start)
 
-        app.logger.debug("Doesn't need patch")
-        admission_response = {
-            "allowed": True,
-            "uid": request_info["request"]["uid"],
-        }
+    # The patch is tiny, so it is always encoded with the standard library for a stable format
+    patch_json = json.dumps(patch)
+
+    app.logger.debug("JSON Patch: %s", patch_json)
+
+    admissionReview = admission_review(uid, patch_json)
+    phases["patch"] = time.perf_counter() - phase_start
+
+    if cache_key is not None:
+        response_cache.put(compiled_maps.version, cache_key, (decisions, patch_json))
+
+    return complete_admission(admissionReview, phases, swap_times, audit, decisions, "patched", admission_start)
+
+
+# Path to the pod spec for each workload kind. Any other kind (ie. Deployment,
+# StatefulSet, DaemonSet, ReplicaSet or Job) has the pod spec in its pod template.
+POD_SPEC_PATHS = {
+    "Pod": ("spec",),
+    "CronJob": ("spec", "jobTemplate", "spec", "template", "spec"),
+}
+DEFAULT_POD_SPEC_PATH = ("spec", "template", "spec")
+
+# Container lists in a pod spec, in the order they are evaluated and patched
+CONTAINER_FIELDS = ("containers", "initContainers", "ephemeralContainers")
+
+
+def pod_spec_locator(path):
+
+    """Function to return the (path, JSON pointer prefix per container list) to locate the containers of a pod spec"""
+
+    pointer = "/" + "/".join(path)
+
+    return (path, tuple((field, f"{pointer}/{field}/") for field in CONTAINER_FIELDS))
+
+
+POD_SPEC_LOCATORS = {kind: pod_spec_locator(path) for (kind, path) in POD_SPEC_PATHS.items()}
+DEFAULT_POD_SPEC_LOCATOR = pod_spec_locator(DEFAULT_POD_SPEC_PATH)
+
+
+def locate_containers(workload_object, kind):
+
+    """Function to return a flat list of (JSON pointer to the image, container spec) for every container in a workload"""
+
+    (path, container_fields) = POD_SPEC_LOCATORS.get(kind, DEFAULT_POD_SPEC_LOCATOR)
+
+    pod_spec = workload_object
+    for key in path:
+        pod_spec = pod_spec.get(key) or {}
+
+    containers = []
+
+    for (field, pointer) in container_fields:
+        for (index, container_spec) in enumerate(pod_spec.get(field) or ()):
+            containers.append((f"{pointer}{index}/image", container_spec))
+
+    return containers
+
+
+def response_cache_key(kind, containers, disable_label):
+
+    """Function to return the response cache key for the kind, images and disable label value of a workload"""
+
+    # The image pointers are part of the key, so workloads only share a response
+    # when every image is at the same position in the same container list
+    key = hashlib.blake2b(digest_size=16)
+    key.update(f"{kind}\0{disable_label}".encode())
 
-        admissionReview = {
-            "apiVersion": "admission.k8s.io/v1",
-            "kind": "AdmissionReview",
-            "response": admission_response,
+    for (image_path, container_spec) in containers:
+        key.update(f"\0{image_path}\0{container_spec.get('image')}".encode())
+
+    return key.digest()
+
+
+def complete_admission(admissionReview, phases, swap_times, audit, decisions, outcome, admission_start):
+
+    """Function to encode an AdmissionReview response, then record the phase metrics and audit log for the request"""
+
+    phase_start = time.perf_counter()
+    response = json_response(admissionReview)
+    phases["encode"] = time.perf_counter() - phase_start
+
+    observe_phases(phases, swap_times, audit["kind"], outcome)
+    audit_admission(audit, decisions, outcome, time.perf_counter() - admission_start)
+
+    return response
+
+
+def audit_admission(audit, decisions, outcome, seconds):
+
+    """Function to log a single JSON audit record for an admission
+
+    Admissions that don't change any image are sampled with IMAGESWAP_AUDIT_SAMPLE_RATE,
+    which is included in their records so counts can be scaled back up.
+    """
+
+    if not audit_logger.isEnabledFor(logging.INFO):
+        return
+
+    record = dict(audit, outcome=outcome)
+
+    if outcome != "patched":
+        if imageswap_audit_sample_rate < 1:
+            if random.random() >= imageswap_audit_sample_rate:
+                return
+            record["sample_rate"] = imageswap_audit_sample_rate
+
+    record["images"] = [
+        {
+            "path": image_path,
+            "image": decision.image,
+            "new_image": decision.new_image if decision.new_image != decision.image else None,
+            "rule": decision.rule,
+            "map": decision.map_key,
         }
+        for (image_path, decision) in decisions
+    ]
+    record["duration_ms"] = round(seconds * 1000, 3)
+
+    audit_logger.info(json.dumps(record))
+
+
+def observe_phases(phases, swap_times, kind, outcome):
+
+    """Function to record the admission phase timings for a request"""
+
+    for (phase, seconds) in phases.items():
+        admission_phase_seconds.labels(phase, kind, outcome).observe(seconds)
+
+    if swap_times:
+        swap_metric = admission_phase_seconds.labels("swap", kind, outcome)
+        for seconds in swap_times:
+            swap_metric.observe(seconds)
+
+
+def json_response(admissionReview):
+
+    """Function to encode an AdmissionReview response with the configured JSON backend"""
+
+    response_body = json_backend.dumps(admissionReview)
+
+    if app.logger.isEnabledFor(logging.DEBUG):
+        app.logger.debug("Admission Review: %s", response_body.decode())
+
+    return (200, response_body, "application/json")
+
+
+def workload_name(workload_metadata, uid):
+
+    """Function to return a name to identify a workload by in logs"""
+
+    # Detect if "name" in object metadata
+    # this was added because the request object for pods doesn't
+    # include a "name" field in the object metadata. This is because generateName
+    # occurs Server Side post-admission
+    if "name" in workload_metadata:
+
+        return workload_metadata["name"]
+
+    elif "generateName" in workload_metadata:
 
-    app.logger.info("Sending Response to K8s API Server")
-    app.logger.debug(f"Admission Review: {json.dumps(admissionReview)}")
+        return workload_metadata["generateName"]
 
-    return jsonify(admissionReview)
+    return uid
+
+
+def admission_review(uid, patch_json=None):
+
+    """Function to build the AdmissionReview response, with an optional JSONPatch"""
+
+    admission_response = {
+        "allowed": True,
+        "uid": uid,
+    }
+
+    if patch_json is not None:
+        admission_response["patch"] = base64.b64encode(patch_json.encode()).decode()
+        admission_response["patchType"] = "JSONPatch"
+
+    return {
+        "apiVersion": "admission.k8s.io/v1",
+        "kind": "AdmissionReview",
+        "response": admission_response,
+    }
 
 
 ################################################################################
@@ -180,20 +547,84 @@ def mutate():
 ################################################################################
 
 
+@app.route("/debug/profile", methods=["POST"])
+def profile():
+
+    """Function to profile the admissions handled by this process, only available when IMAGESWAP_PROFILING_TOKEN is set"""
+
+    (status, response_body, content_type) = profiling.profile_request(request.args, request.headers.get("Authorization"))
+
+    return Response(response_body, status=status, content_type=content_type)
+
+
+@app.route("/v1/evaluate", methods=["POST"])
+def evaluate():
+
+    """Function to return the swapped image and the deciding rule for a list of images"""
+
+    (status, response_body, content_type) = evaluate_request(request.get_data(cache=False))
+
+    return Response(response_body, status=status, content_type=content_type)
+
+
+def evaluate_request(request_body):
+
+    """Function to evaluate a raw '{"images": [...]}' request body and return the (status, body, content type) of the response
+
+    This is shared by the WSGI and ASGI servers.
+    """
+
+    try:
+        evaluate_info = json_backend.loads(request_body)
+        images = evaluate_info["images"]
+        if not isinstance(images, list) or not all(isinstance(image, str) and image for image in images):
+            raise ValueError('"images" must be a list of image references')
+        # The map overlays of a namespace and pod labels are used when they are given
+        namespace = evaluate_info.get("namespace")
+        if namespace is not None and not isinstance(namespace, str):
+            raise ValueError('"namespace" must be a string')
+        labels = evaluate_info.get("labels") or {}
+        if not isinstance(labels, dict) or not all(isinstance(key, str) and isinstance(value, str) for (key, value) in labels.items()):
+            raise ValueError('"labels" must be a map of pod label names to string values')
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        app.logger.error(f"Unable to decode evaluate request: {e}")
+        return (400, b"Invalid evaluate request", "text/plain")
+
+    compiled_maps = overlay_swap_maps(get_swap_maps(imageswap_maps_file), namespace, labels) if imageswap_mode.lower() == "maps" else None
+
+    results = [
+        {
+            "image": decision.image,
+            "new_image": decision.new_image if decision.new_image is not None else decision.image,
+            "swapped": decision.new_image is not None and decision.new_image != decision.image,
+            "rule": decision.rule,
+            "map": decision.map_key,
+        }
+        for decision in evaluate_images(images, compiled_maps)
+    ]
+
+    return (200, json_backend.dumps({"images": results}), "application/json")
+
+
 @app.route("/healthz", methods=["GET"])
 def healthz():
 
     """Function to return health info for app"""
 
-    health_response = {
+    # Return JSON formatted response object
+    return jsonify(health_info())
+
+
+def health_info():
+
+    """Function to build the health info for the app"""
+
+    return {
         "pod_name": imageswap_pod_name,
         "date_time": str(datetime.datetime.now()),
         "health": "ok",
     }
 
-    # Return JSON formatted response object
-    return jsonify(health_response)
-
 
 ################################################################################
 ################################################################################
@@ -262,166 +693,1014 @@ def build_swap_map(map_file):
 ################################################################################
 
 
-def swap_image(container_spec):
+def build_trie_regex(words):
 
-    """Function to perform imageswap for a container spec"""
+    """Function to compile a list of literal strings into a single trie structured regex
+
+    Common prefixes are factored out (ie. "a.io" and "a.com" become "a\\.(?:com|io)"),
+    so a search checks each character of the subject against all words at once
+    instead of scanning the subject once per word.
+    """
+
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = True
+
+    def build(node):
+
+        # A word ends here, so any longer word sharing this prefix is redundant for a search
+        if "" in node:
+            return ""
+
+        branches = [re.escape(char) + build(child) for (char, child) in sorted(node.items())]
+
+        if len(branches) == 1:
+            return branches[0]
+
+        return "(?:" + "|".join(branches) + ")"
+
+    return re.compile(build(trie))
+
+
+class ImageReference(collections.namedtuple("ImageReference", ["registry", "port", "path", "tag", "digest", "explicit_registry"])):
+
+    """Class to hold a parsed image reference
+
+    "registry" is the registry host without its port ("docker.io" when the image
+    doesn't name a registry), "port", "tag" and "digest" are None when absent and
+    "path" is the repository path (ie. "library/nginx" is just "nginx").
+    """
+
+    __slots__ = ()
+
+    @property
+    def domain(self):
+
+        """Property for the registry as written in an image, including the port"""
+
+        return self.registry if self.port is None else f"{self.registry}:{self.port}"
+
+    @property
+    def library(self):
+
+        """Property for whether the image is a single name on the default registry (ie. "nginx:latest")"""
+
+        return not self.explicit_registry and "/" not in self.path
 
-    name = container_spec["name"]
-    image = container_spec["image"]
-    new_image = image
-    image_split = image.partition("/")
-    wildcard_maps = {}
-    no_registry = False
-    library_image = False
-
-    # Check if first section is a Registry URL
-    if "." in image_split[0] and image_split[1] != "" and image_split[2] != "":
-        image_registry = image_split[0]
+    @property
+    def unqualified(self):
+
+        """Property for the image without its registry"""
+
+        unqualified = self.path
+        if self.tag is not None:
+            unqualified += ":" + self.tag
+        if self.digest is not None:
+            unqualified += "@" + self.digest
+
+        return unqualified
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_image(image):
+
+    """Function to parse an image reference, memoized since the same images are seen over and over
+
+    Like Docker, the first component of the image is only a registry when it is
+    followed by a "/" and contains a "." or a ":<port_number>" or is "localhost".
+    """
+
+    (name, _, digest) = image.partition("@")
+    (first, slash, rest) = name.partition("/")
+
+    if slash and ("." in first or ":" in first or first == "localhost"):
+        (domain, remainder, explicit_registry) = (first, rest, True)
     else:
-        # Set docker.io if no registry is detected
-        image_registry = "docker.io"
-        no_registry = True
+        (domain, remainder, explicit_registry) = ("docker.io", name, False)
 
-    # Set the image registry key to work with
-    image_registry_key = image_registry
+    # A tag is the part after the last ":" in the last component of the path
+    (path, colon, tag) = remainder.rpartition(":")
+    if not colon or "/" in tag:
+        (path, tag) = (remainder, "")
 
-    # Check the imageswap mode
-    if imageswap_mode.lower() == "maps":
+    (registry, _, port) = domain.partition(":")
+
+    return ImageReference(registry, port or None, path, tag or None, digest or None, explicit_registry)
+
+
+class MapRule:
+
+    """Class to hold the precomputed rewrite action for a single registry map"""
+
+    __slots__ = ("key", "value", "skip", "dash", "default")
 
-        app.logger.info('ImageSwap Webhook running in "MAPS" mode')
+    def __init__(self, key, value, default=False):
 
-        (replace_maps, exact_maps, swap_maps) = build_swap_map(imageswap_maps_file)
+        self.key = key
+        self.value = value
+        # A map with no value disables swapping
+        self.skip = value == ""
+        # A map value ending with "-" is prefixed to the existing image
+        self.dash = not self.skip and value[-1] == "-"
+        self.default = default
 
-        app.logger.debug(f"Swap Maps:\n{swap_maps}")
-        app.logger.debug(f"Exact Maps:\n{exact_maps}")
-        app.logger.debug(f"Replace Maps:\n{replace_maps}")
+    def rewrite(self, image, reference, image_registry_key):
 
-        found = False
-        if image in exact_maps:
-            app.logger.debug("found exact mapping")
-            new_image = exact_maps[image]
-            found = True
+        """Method to return the swapped image for this map, or None if swapping should be skipped"""
+
+        if self.skip:
+            return None
+
+        if self.default:
+            if self.dash:
+                return self.value + reference.registry + "/" + image
+            elif image_registry_key in image:
+                return image.replace(reference.domain, self.value)
+            return self.value + "/" + image
+
+        if self.dash:
+            # The registry (without its port) is kept as part of the image name
+            return self.value + reference.registry + "/" + reference.unqualified
+        elif self.key in image:
+            return image.replace(self.key, self.value)
+
+        return self.value + "/" + image
+
+
+class SwapMaps:
+
+    """Class to hold a compiled, read-only set of imageswap maps"""
+
+    def __init__(self, replace_maps, exact_maps, maps, version=0, fingerprint=None):
+
+        self.replace_maps = replace_maps
+        self.exact_maps = exact_maps
+        self.maps = maps
+        self.version = version
+        self.fingerprint = fingerprint
+        self.overlays = ()
+
+        # All replace patterns are combined into a single regex with one named group per
+        # pattern. Alternatives are tried in file order, so the first matching pattern wins.
+        self.replace_patterns = list(replace_maps)
+        if self.replace_patterns:
+            self.replace_regex = re.compile("|".join(f"(?P<r{i}>{fnmatch.translate(pattern)})" for (i, pattern) in enumerate(self.replace_patterns)))
+        else:
+            self.replace_regex = None
+
+        # Wildcards are trimmed and compiled once so an image is scanned in a single pass
+        self.noswap_wildcards = [wildcard.strip() for wildcard in maps.get(imageswap_maps_wildcard_key, "").split(",") if wildcard.strip()]
+        if self.noswap_wildcards:
+            self.noswap_regex = build_trie_regex(self.noswap_wildcards)
         else:
-            # Check to see if a replacement pattern matches
-            for pattern in replace_maps.keys():
-                if fnmatch.fnmatch(image, pattern):
-                    new_image = os.path.join(replace_maps[pattern], image.split("/")[-1])
-                    found = True
-                    break
-
-        # Fallback to standard checks if the image has not been found
-        if not found:
-            # Check if Registry portion includes a ":<port_number>"
-            if ":" in image_registry:
-                image_registry_noport = image_registry.partition(":")[0]
+            self.noswap_regex = None
+
+        if imageswap_maps_default_key in maps:
+            self.default_rule = MapRule(imageswap_maps_default_key, maps[imageswap_maps_default_key], default=True)
+        else:
+            self.default_rule = None
+
+        # Index of registry -> (registry map, "<registry>/library" map) so a registry
+        # resolves to its rewrite action with a single dict lookup
+        self.registry_index = {}
+        for (key, val) in maps.items():
+            if key in (imageswap_maps_default_key, imageswap_maps_wildcard_key):
+                continue
+            if key.endswith("/library"):
+                registry = key[: -len("/library")]
+                entry = self.registry_index.get(registry, (None, None))
+                self.registry_index[registry] = (entry[0], MapRule(key, val))
             else:
-                image_registry_noport = image_registry
+                entry = self.registry_index.get(key, (None, None))
+                self.registry_index[key] = (MapRule(key, val), entry[1])
 
-            if image_registry not in swap_maps and image_registry_noport in swap_maps:
+    def match_replace(self, image):
+
+        """Method to return the first replace pattern (in file order) matching an image, or None"""
+
+        if self.replace_regex is None:
+            return None
+
+        match = self.replace_regex.match(image)
+        if match is None:
+            return None
+
+        return self.replace_patterns[int(match.lastgroup[1:])]
+
+    def match_noswap(self, image):
+
+        """Method to return a noswap wildcard contained in an image, or None"""
+
+        if self.noswap_regex is None:
+            return None
+
+        match = self.noswap_regex.search(image)
+        if match is None:
+            return None
+
+        return match.group(0)
+
+    def resolve_registry(self, image_registry, image_registry_noport, library_image):
+
+        """Method to return the registry key and map rule that applies to an image registry
+
+        The registry is looked up as-is first and without its ":<port_number>" second.
+        Library images prefer a "<registry>/library" map when one exists. If no registry
+        map applies, the rule is None.
+        """
+
+        entry = self.registry_index.get(image_registry)
+        image_registry_key = image_registry
+
+        if (entry is None or entry[0] is None) and image_registry_noport != image_registry:
+            noport_entry = self.registry_index.get(image_registry_noport)
+            if noport_entry is not None and noport_entry[0] is not None:
+                entry = noport_entry
                 image_registry_key = image_registry_noport
 
-            # Verify the default map exists or skip swap
-            if imageswap_maps_default_key not in swap_maps:
-                app.logger.warning(f'You don\'t have a "{imageswap_maps_default_key}" entry in your ImageSwap Map config, skipping swap')
-                return False
+        if entry is None:
+            return (image_registry_key, None)
 
-            # Check for noswap wildcards in map file
-            if imageswap_maps_wildcard_key in swap_maps and swap_maps[imageswap_maps_wildcard_key] != "":
-                wildcard_maps = str(swap_maps[imageswap_maps_wildcard_key]).split(",")
+        if library_image and entry[1] is not None:
+            return (entry[1].key, entry[1])
 
-            # Check if registry or registry+library has a map specified
-            if image_registry_key in swap_maps or image_registry_key + "/library" in swap_maps:
+        return (image_registry_key, entry[0])
 
-                # Check for Library image (ie. empty strings for index 1 an 2 in image_split)
-                if image_split[1] == "" and image_split[2] == "":
-                    library_image = True
-                    app.logger.debug("Image is a Library image")
-                else:
-                    app.logger.debug("Image is not a Library image")
-
-                if library_image and image_registry_key + "/library" in swap_maps:
-
-                    image_registry_key = image_registry_key + "/library"
-                    app.logger.info(f"Library Image detected and matching Map found: {image_registry_key}")
-                    app.logger.debug("More info on Library Image: https://docs.docker.com/registry/introduction/#understanding-image-naming")
-
-                # If the swap map has no value, swapping should be skipped
-                if swap_maps[image_registry_key] == "":
-                    app.logger.debug(f'Swap map for "{image_registry_key}" has no value assigned, skipping swap')
-                    return False
-                # If the image prefix ends with "-" just append existing image (minus any ":<port_number>")
-                elif swap_maps[image_registry_key][-1] == "-":
-                    if no_registry:
-                        new_image = swap_maps[image_registry_key] + image_registry_noport + "/" + re.sub(r":.*/", "/", image)
-                    else:
-                        new_image = swap_maps[image_registry_key] + re.sub(r":.*/", "/", image)
-                # If the image registry pattern is found in the original image
-                elif image_registry_key in image:
-                    new_image = re.sub(image_registry_key, swap_maps[image_registry_key], image)
-                # For everything else
-                else:
-                    new_image = swap_maps[image_registry_key] + "/" + image
+    @classmethod
+    def from_file(cls, map_file, version=0, fingerprint=None):
 
-                app.logger.debug(f'Swap Map = "{image_registry_key}" : "{swap_maps[image_registry_key]}"')
+        """Method to parse a map file and compile it into a SwapMaps object"""
+
+        (replace_maps, exact_maps, maps) = build_swap_map(map_file)
+
+        return cls(replace_maps, exact_maps, maps, version=version, fingerprint=fingerprint)
+
+    def validate(self):
+
+        """Method to sanity check compiled maps before they replace a known good version"""
+
+        if not self.maps and not self.exact_maps and not self.replace_maps:
+            raise ValueError("map file does not contain any valid maps")
+
+        if imageswap_maps_default_key not in self.maps:
+            app.logger.warning(f'You don\'t have a "{imageswap_maps_default_key}" entry in your ImageSwap Map config')
+
+
+# Process-wide cache of compiled maps, keyed by map file path. Each entry is a
+# [SwapMaps, last_checked] pair so freshness checks only stat the file once per
+# check interval instead of re-reading it for every container.
+_swap_maps_cache = {}
+_swap_maps_lock = threading.Lock()
+_swap_maps_versions = itertools.count(1)
+
+# Map files whose cache entries are kept current by a MapsWatcher. Lookups for
+# these files are served straight from the cache without touching the filesystem.
+_watched_maps_files = set()
+
+
+def _reset_swap_maps_lock():
+
+    """Function to replace the map cache lock in a forked child, in case another thread held it during the fork"""
+
+    global _swap_maps_lock
+
+    _swap_maps_lock = threading.Lock()
 
-            # Check if any of the noswap wildcard patterns from the swap map exist within the original image
-            elif len(wildcard_maps) > 0 and any(noswap in image for noswap in wildcard_maps):
-                app.logger.debug(f"Image matches a configured noswap_wildcard pattern, skipping swap")
-                app.logger.debug(f'Swap Map = "noswap_wilcard" : "{wildcard_maps}"')
-                return False
-            # Using Default image swap map
-            else:
 
-                app.logger.debug(f'No Swap map for "{image_registry_key}" detected, using default map')
-                app.logger.debug(f'Swap Map = "default" : "{swap_maps[imageswap_maps_default_key]}"')
+os.register_at_fork(after_in_child=_reset_swap_maps_lock)
 
-                if swap_maps[imageswap_maps_default_key] == "":
-                    app.logger.debug(f"Default map has no value assigned, skipping swap")
-                    return False
-                elif swap_maps[imageswap_maps_default_key][-1] == "-":
-                    new_image = swap_maps[imageswap_maps_default_key] + image_registry_noport + "/" + image
-                elif image_registry_key in image:
-                    new_image = re.sub(image_registry, swap_maps[imageswap_maps_default_key], image)
+
+def map_file_fingerprint(map_file):
+
+    """Function to return a cheap identity for the current contents of a map file"""
+
+    stat = os.stat(map_file)
+
+    return (stat.st_dev, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def get_swap_maps(map_file=None):
+
+    """Function to return the compiled imageswap maps, rebuilding them only when the map file changes"""
+
+    if map_file is None:
+        map_file = imageswap_maps_file
+
+    cached = _swap_maps_cache.get(map_file)
+
+    # Maps kept current by a background watcher never need a freshness check
+    if cached is not None and map_file in _watched_maps_files:
+        return cached[0]
+
+    now = time.monotonic()
+
+    # Skip the stat entirely while the cached maps are within the check interval
+    if cached is not None and now - cached[1] < imageswap_maps_check_interval:
+        return cached[0]
+
+    try:
+        fingerprint = map_file_fingerprint(map_file)
+    except OSError as e:
+        if cached is None:
+            raise
+        app.logger.warning(f'Unable to stat map file "{map_file}", continuing with previously loaded maps: {e}')
+        cached[1] = now
+        return cached[0]
+
+    if cached is not None and cached[0].fingerprint == fingerprint:
+        cached[1] = now
+        return cached[0]
+
+    with _swap_maps_lock:
+
+        # Another thread may have rebuilt the maps while we waited on the lock
+        cached = _swap_maps_cache.get(map_file)
+        if cached is not None and cached[0].fingerprint == fingerprint:
+            cached[1] = now
+            return cached[0]
+
+        swap_maps = SwapMaps.from_file(map_file, version=next(_swap_maps_versions), fingerprint=fingerprint)
+        _swap_maps_cache[map_file] = [swap_maps, now]
+
+    app.logger.info(f'Loaded ImageSwap maps from "{map_file}" (version {swap_maps.version})')
+    app.logger.debug("Swap Maps:\n%s", swap_maps.maps)
+    app.logger.debug("Exact Maps:\n%s", swap_maps.exact_maps)
+    app.logger.debug("Replace Maps:\n%s", swap_maps.replace_maps)
+
+    return swap_maps
+
+
+class MapOverlays:
+
+    """Class to hold the map overlays of an overlay directory, indexed by namespace and label
+
+    Each overlay is a map file that applies on top of the global maps to the namespaces
+    listed by its "namespaces" key and/or the pods matching its "selector" key. The maps
+    that apply to a request are merged and compiled once into a view that is cached for
+    every other request with the same overlays, so lookups cost the same no matter how
+    many overlays there are.
+    """
+
+    # Bound on the number of cached views, which only grows with the distinct combinations of overlays seen
+    max_views = 1024
+
+    def __init__(self, overlays, version=0, fingerprint=None):
+
+        self.overlays = overlays
+        self.version = version
+        self.fingerprint = fingerprint
+        self.views = {}
+        self.base_version = None
+
+        # Index of namespace -> overlays that apply to it, in overlay order. Overlays without
+        # a namespace restriction apply to every namespace.
+        self.any_namespace = tuple(index for (index, overlay) in enumerate(overlays) if overlay.namespaces is None)
+        namespace_overlays = collections.defaultdict(set)
+        for (index, overlay) in enumerate(overlays):
+            for namespace in overlay.namespaces or ():
+                namespace_overlays[namespace].add(index)
+        self.namespace_index = {namespace: tuple(sorted(indexes.union(self.any_namespace))) for (namespace, indexes) in namespace_overlays.items()}
+
+        # Index of (label, value) -> overlays whose selector requires it. An overlay matches
+        # when every requirement of its selector is met.
+        self.selector_index = collections.defaultdict(list)
+        for (index, overlay) in enumerate(overlays):
+            for requirement in overlay.selector.items():
+                self.selector_index[requirement].append(index)
+        self.selector_sizes = [len(overlay.selector) for overlay in overlays]
+
+    def match(self, namespace, labels):
+
+        """Method to return the indexes of the overlays that apply to a namespace and pod labels, in overlay order"""
+
+        candidates = self.namespace_index.get(namespace, self.any_namespace)
+
+        if not candidates:
+            return ()
+
+        matched = collections.Counter()
+        if self.selector_index:
+            for requirement in labels.items():
+                for index in self.selector_index.get(requirement, ()):
+                    matched[index] += 1
+
+        return tuple(index for index in candidates if matched[index] == self.selector_sizes[index])
+
+    def view(self, base_maps, namespace, labels):
+
+        """Method to return the compiled maps for a namespace and pod labels, merging and compiling them on first use"""
+
+        indexes = self.match(namespace, labels)
+
+        if not indexes:
+            return base_maps
+
+        key = (base_maps.version, indexes)
+        view = self.views.get(key)
+
+        if view is None:
+            view = self.merge(base_maps, [self.overlays[index] for index in indexes])
+            # Views of previous global maps are never used again
+            if len(self.views) >= self.max_views or base_maps.version != self.base_version:
+                self.views = {}
+                self.base_version = base_maps.version
+            self.views[key] = view
+            app.logger.debug("Compiled ImageSwap maps view (version %s) for overlays: %s", view.version, ", ".join(overlay.name for overlay in view.overlays))
+
+        return view
+
+    @staticmethod
+    def merge(base_maps, overlays):
+
+        """Method to compile the global maps with overlays applied in order, later overlays taking precedence"""
+
+        layers = [(base_maps.replace_maps, base_maps.exact_maps, base_maps.maps)] + [overlay.maps for overlay in overlays]
+
+        exact_maps = {}
+        maps = {}
+        for (_, layer_exact_maps, layer_maps) in layers:
+            exact_maps.update(layer_exact_maps)
+            maps.update(layer_maps)
+
+        # Replace patterns are tried in order, so the patterns of the last overlay go first
+        replace_maps = {}
+        for (layer_replace_maps, _, _) in reversed(layers):
+            for (pattern, value) in layer_replace_maps.items():
+                replace_maps.setdefault(pattern, value)
+
+        view = SwapMaps(replace_maps, exact_maps, maps, version=next(_swap_maps_versions))
+        view.overlays = overlays
+
+        return view
+
+    @classmethod
+    def from_dir(cls, overlay_dir, version=0, fingerprint=None):
+
+        """Method to parse the map files in an overlay directory, in file name order"""
+
+        if fingerprint is None:
+            fingerprint = overlay_dir_fingerprint(overlay_dir)
+
+        overlays = []
+
+        for (name, _) in fingerprint:
+            (replace_maps, exact_maps, maps) = build_swap_map(os.path.join(overlay_dir, name))
+            namespaces = maps.pop(imageswap_maps_namespaces_key, None)
+            selector = maps.pop(imageswap_maps_selector_key, None)
+
+            if namespaces is None and selector is None:
+                app.logger.warning(f'Map overlay "{name}" has no "{imageswap_maps_namespaces_key}" or "{imageswap_maps_selector_key}" key, skipping it')
+                continue
+
+            if namespaces is not None:
+                namespaces = frozenset(namespace for namespace in namespaces.split(",") if namespace)
+            requirements = [requirement.partition("=") for requirement in (selector or "").split(",") if requirement]
+            selector = {label: value for (label, _, value) in requirements}
+
+            overlays.append(MapOverlay(name, namespaces, selector, (replace_maps, exact_maps, maps)))
+
+        return cls(overlays, version=version, fingerprint=fingerprint)
+
+
+MapOverlay = collections.namedtuple("MapOverlay", ["name", "namespaces", "selector", "maps"])
+
+# Process-wide cache of map overlays, keyed by overlay directory. Like the map cache,
+# each entry is a [MapOverlays, last_checked] pair.
+_map_overlays_cache = {}
+
+
+def overlay_dir_fingerprint(overlay_dir):
+
+    """Function to return a cheap identity for the current map files in an overlay directory"""
+
+    try:
+        # Hidden entries are skipped, which includes the "..data" links of ConfigMap volumes
+        names = sorted(entry.name for entry in os.scandir(overlay_dir) if not entry.name.startswith(".") and entry.is_file())
+    except FileNotFoundError:
+        return ()
+
+    return tuple((name, map_file_fingerprint(os.path.join(overlay_dir, name))) for name in names)
+
+
+def get_map_overlays(overlay_dir):
+
+    """Function to return the map overlays of a directory, reloading them only when its map files change"""
+
+    cached = _map_overlays_cache.get(overlay_dir)
+    now = time.monotonic()
+
+    if cached is not None and now - cached[1] < imageswap_maps_check_interval:
+        return cached[0]
+
+    try:
+        fingerprint = overlay_dir_fingerprint(overlay_dir)
+    except OSError as e:
+        if cached is None:
+            raise
+        app.logger.warning(f'Unable to read map overlay directory "{overlay_dir}", continuing with previously loaded overlays: {e}')
+        cached[1] = now
+        return cached[0]
+
+    if cached is not None and cached[0].fingerprint == fingerprint:
+        cached[1] = now
+        return cached[0]
+
+    with _swap_maps_lock:
+
+        cached = _map_overlays_cache.get(overlay_dir)
+        if cached is not None and cached[0].fingerprint == fingerprint:
+            cached[1] = now
+            return cached[0]
+
+        map_overlays = MapOverlays.from_dir(overlay_dir, version=next(_swap_maps_versions), fingerprint=fingerprint)
+        _map_overlays_cache[overlay_dir] = [map_overlays, now]
+
+    app.logger.info(f'Loaded {len(map_overlays.overlays)} ImageSwap map overlays from "{overlay_dir}" (version {map_overlays.version})')
+
+    return map_overlays
+
+
+def overlay_swap_maps(compiled_maps, namespace, labels):
+
+    """Function to return the compiled maps that apply to a namespace and pod labels"""
+
+    if not imageswap_maps_overlay_dir:
+        return compiled_maps
+
+    try:
+        map_overlays = get_map_overlays(imageswap_maps_overlay_dir)
+    except OSError as e:
+        app.logger.error(f'Unable to load map overlays from "{imageswap_maps_overlay_dir}", using the global maps: {e}')
+        return compiled_maps
+
+    return map_overlays.view(compiled_maps, namespace, labels)
+
+
+################################################################################
+################################################################################
+################################################################################
+
+
+# inotify constants from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+IN_WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+
+class MapsWatcher(threading.Thread):
+
+    """Class to reload the imageswap maps in the background when the map file changes
+
+    ConfigMap volumes are updated by the kubelet by atomically swapping the "..data"
+    symlink in the mount directory, so the directory holding the map file is watched
+    with inotify. When inotify is unavailable the watcher falls back to polling.
+    """
+
+    def __init__(self, map_file, interval=5, debounce=0.1, on_reload=None):
+
+        super().__init__(name="imageswap-maps-watcher", daemon=True)
+        self.map_file = map_file
+        self.interval = interval
+        self.debounce = debounce
+        self.on_reload = on_reload
+        self.inotify_fd = None
+        self.stop_event = threading.Event()
+
+    def open_inotify(self):
+
+        """Method to setup an inotify watch for the directory holding the map file"""
+
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+            watch_dir = os.path.dirname(os.path.abspath(self.map_file))
+            if libc.inotify_add_watch(fd, os.fsencode(watch_dir), IN_WATCH_MASK) < 0:
+                errno = ctypes.get_errno()
+                os.close(fd)
+                raise OSError(errno, f'inotify_add_watch failed for "{watch_dir}"')
+        except (AttributeError, OSError) as e:
+            app.logger.warning(f"Unable to watch map file with inotify, falling back to polling every {self.interval}s: {e}")
+            return None
+
+        app.logger.info(f'Watching "{watch_dir}" for map file changes')
+
+        return fd
+
+    def reload(self):
+
+        """Method to recompile the maps if the map file changed, keeping the previous maps if the new file is invalid"""
+
+        try:
+            fingerprint = map_file_fingerprint(self.map_file)
+        except OSError as e:
+            app.logger.warning(f'Unable to stat map file "{self.map_file}", keeping previously loaded maps: {e}')
+            return False
+
+        cached = _swap_maps_cache.get(self.map_file)
+        if cached is not None and cached[0].fingerprint == fingerprint:
+            return False
+
+        try:
+            swap_maps = SwapMaps.from_file(self.map_file, fingerprint=fingerprint)
+            if cached is not None:
+                swap_maps.validate()
+        except Exception as e:
+            app.logger.error(f'Invalid map file "{self.map_file}", keeping previously loaded maps: {e}')
+            return False
+
+        swap_maps.version = next(_swap_maps_versions)
+
+        # Publishing is a single dict assignment, so request threads see either the old or new maps
+        with _swap_maps_lock:
+            _swap_maps_cache[self.map_file] = [swap_maps, time.monotonic()]
+
+        app.logger.info(f'Reloaded ImageSwap maps from "{self.map_file}" (version {swap_maps.version})')
+
+        return True
+
+    def run(self):
+
+        self.inotify_fd = self.open_inotify()
+
+        try:
+            while not self.stop_event.is_set():
+                if self.inotify_fd is not None:
+                    (readable, _, _) = select.select([self.inotify_fd], [], [], self.interval)
+                    if readable:
+                        # Let the kubelet finish the symlink swap, then drain all queued events
+                        self.stop_event.wait(self.debounce)
+                        try:
+                            while os.read(self.inotify_fd, 65536):
+                                pass
+                        except BlockingIOError:
+                            pass
                 else:
-                    new_image = swap_maps[imageswap_maps_default_key] + "/" + image
+                    self.stop_event.wait(self.interval)
+
+                if not self.stop_event.is_set() and self.reload() and self.on_reload is not None:
+                    self.on_reload()
+        finally:
+            if self.inotify_fd is not None:
+                os.close(self.inotify_fd)
+
+    def stop(self):
+
+        self.stop_event.set()
+
+
+_maps_watcher = None
+
+# PID of a preloaded gunicorn master that watches the map file on behalf of its workers
+_maps_master_pid = None
+
+
+def start_maps_watcher(map_file=None, on_reload=None):
+
+    """Function to load the maps and start a background watcher for the map file in this process"""
 
-    # TO-DO (phenixblue): Remove this else block sometime in the future...
-    # This "else" block maintains the legacy imageswap logic, which is now
-    # deprecated.
+    global _maps_watcher
+
+    if map_file is None:
+        map_file = imageswap_maps_file
+
+    if not imageswap_maps_watch or imageswap_mode.lower() != "maps":
+        return None
+
+    # Workers forked from a preloaded master are replaced by the master when the map file changes
+    if _maps_master_pid is not None and _maps_master_pid != os.getpid():
+        return None
+
+    # Threads don't survive a fork, so a watcher inherited from a parent process is discarded
+    if _maps_watcher is not None and _maps_watcher.is_alive() and _maps_watcher.map_file == map_file:
+        return _maps_watcher
+
+    try:
+        get_swap_maps(map_file)
+    except OSError as e:
+        app.logger.warning(f'Unable to load map file "{map_file}": {e}')
+
+    _maps_watcher = MapsWatcher(map_file, interval=imageswap_maps_watch_interval, on_reload=on_reload)
+    _maps_watcher.start()
+    _watched_maps_files.add(map_file)
+
+    return _maps_watcher
+
+
+def start_master_maps_watcher(map_file=None):
+
+    """Function to compile the maps in a preloaded gunicorn master and watch the map file for its workers
+
+    Workers forked from the master share the compiled maps copy-on-write. When the
+    map file changes the master recompiles the maps and sends itself a SIGHUP, so
+    gunicorn gracefully replaces the workers with new ones forked from the master.
+    """
+
+    global _maps_master_pid
+
+    if map_file is None:
+        map_file = imageswap_maps_file
+
+    if imageswap_mode.lower() != "maps":
+        return None
+
+    _maps_master_pid = os.getpid()
+
+    try:
+        get_swap_maps(map_file)
+    except OSError as e:
+        app.logger.warning(f'Unable to load map file "{map_file}": {e}')
+
+    return start_maps_watcher(map_file, on_reload=lambda: os.kill(_maps_master_pid, signal.SIGHUP))
+
+
+def stop_maps_watcher():
+
+    """Function to stop the background map file watcher"""
+
+    global _maps_watcher
+
+    if _maps_watcher is not None:
+        _maps_watcher.stop()
+        _maps_watcher.join()
+        _watched_maps_files.discard(_maps_watcher.map_file)
+        _maps_watcher = None
+
+
+################################################################################
+################################################################################
+################################################################################
+
+
+# Result of evaluating an image against the imageswap configuration. "new_image"
+# is None when the image should not be swapped and "rule" names the map type
+# that decided it (exact, replace, registry, library, noswap, default, no_default
+# or legacy).
+SwapDecision = collections.namedtuple("SwapDecision", ["image", "new_image", "rule", "map_key"])
+
+
+def map_image(image, compiled_maps):
+
+    """Function to evaluate an image against compiled imageswap maps"""
+
+    if image in compiled_maps.exact_maps:
+        app.logger.debug("found exact mapping")
+        return SwapDecision(image, compiled_maps.exact_maps[image], "exact", image)
+
+    # Check to see if a replacement pattern matches
+    pattern = compiled_maps.match_replace(image)
+    if pattern is not None:
+        app.logger.debug('found replace mapping for pattern "%s"', pattern)
+        return SwapDecision(image, os.path.join(compiled_maps.replace_maps[pattern], image.split("/")[-1]), "replace", pattern)
+
+    # Fallback to standard checks if the image has not been found
+    reference = parse_image(image)
+
+    # Verify the default map exists or skip swap
+    if compiled_maps.default_rule is None:
+        app.logger.warning(f'You don\'t have a "{imageswap_maps_default_key}" entry in your ImageSwap Map config, skipping swap')
+        return SwapDecision(image, None, "no_default", None)
+
+    # Check if registry or registry+library has a map specified
+    (image_registry_key, rule) = compiled_maps.resolve_registry(reference.domain, reference.registry, reference.library)
+
+    if rule is not None:
+
+        rule_type = "registry"
+        if rule.key.endswith("/library") and reference.library:
+            rule_type = "library"
+            app.logger.debug('Library Image detected and matching Map found: "%s"', image_registry_key)
+            app.logger.debug("More info on Library Image: https://docs.docker.com/registry/introduction/#understanding-image-naming")
+
+        app.logger.debug('Swap Map = "%s" : "%s"', image_registry_key, rule.value)
+
+        new_image = rule.rewrite(image, reference, image_registry_key)
+
+        # If the swap map has no value, swapping should be skipped
+        if new_image is None:
+            app.logger.debug('Swap map for "%s" has no value assigned, skipping swap', image_registry_key)
+
+        return SwapDecision(image, new_image, rule_type, image_registry_key)
+
+    # Check if any of the noswap wildcard patterns from the swap map exist within the original image
+    noswap_wildcard = compiled_maps.match_noswap(image)
+    if noswap_wildcard is not None:
+        app.logger.debug("Image matches a configured noswap_wildcard pattern, skipping swap")
+        app.logger.debug('Swap Map = "noswap_wilcard" : "%s"', noswap_wildcard)
+        return SwapDecision(image, None, "noswap", noswap_wildcard)
+
+    # Using Default image swap map
+    app.logger.debug('No Swap map for "%s" detected, using default map', image_registry_key)
+    app.logger.debug('Swap Map = "default" : "%s"', compiled_maps.default_rule.value)
+
+    new_image = compiled_maps.default_rule.rewrite(image, reference, image_registry_key)
+
+    if new_image is None:
+        app.logger.debug("Default map has no value assigned, skipping swap")
+
+    return SwapDecision(image, new_image, "default", imageswap_maps_default_key)
+
+
+################################################################################
+################################################################################
+################################################################################
+
+
+class DecisionCache:
+
+    """Class to hold a bounded LRU cache of image swap decisions (or anything else computed from the maps)
+
+    Entries are keyed by map version, so entries computed from other maps (ie. before a
+    reload or for another namespace's overlays) are never returned and are simply aged
+    out by the LRU.
+    """
+
+    def __init__(self, maxsize, ttl=0, hits=decision_cache_hits, misses=decision_cache_misses, evictions=decision_cache_evictions):
+
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = hits
+        self.misses = misses
+        self.evictions = evictions
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, version, image):
+
+        """Method to return the cached decision for an image, or None on a miss"""
+
+        key = (version, image)
+
+        with self.lock:
+
+            entry = self.entries.get(key)
+
+            if entry is not None and self.ttl and time.monotonic() - entry[1] > self.ttl:
+                del self.entries[key]
+                entry = None
+
+            if entry is None:
+                self.misses.inc()
+                return None
+
+            self.entries.move_to_end(key)
+
+        self.hits.inc()
+
+        return entry[0]
+
+    def put(self, version, image, decision):
+
+        """Method to store the decision for an image, evicting the least recently used decisions"""
+
+        key = (version, image)
+
+        with self.lock:
+
+            self.entries[key] = (decision, time.monotonic())
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions.inc()
+
+    def clear(self):
+
+        with self.lock:
+            self.entries.clear()
+
+
+decision_cache = DecisionCache(imageswap_decision_cache_size, ttl=imageswap_decision_cache_ttl)
+
+# Cache of (decisions, JSONPatch) per workload, off unless IMAGESWAP_RESPONSE_CACHE_SIZE is set
+response_cache = DecisionCache(imageswap_response_cache_size, hits=response_cache_hits, misses=response_cache_misses, evictions=response_cache_evictions)
+
+
+def lookup_image(image, compiled_maps=None):
+
+    """Function to return the swap decision for an image in MAPS mode, using the decision cache"""
+
+    if compiled_maps is None:
+        compiled_maps = get_swap_maps(imageswap_maps_file)
+
+    if decision_cache.maxsize <= 0:
+        return map_image(image, compiled_maps)
+
+    decision = decision_cache.get(compiled_maps.version, image)
+
+    if decision is None:
+        decision = map_image(image, compiled_maps)
+        decision_cache.put(compiled_maps.version, image, decision)
+
+    return decision
+
+
+# TO-DO (phenixblue): Remove this function sometime in the future...
+# This maintains the legacy imageswap logic, which is now deprecated.
+def legacy_image(name, image):
+
+    """Function to evaluate an image against the LEGACY "IMAGE_PREFIX" configuration"""
+
+    app.logger.warning('ImageSwap Webhook running in "LEGACY" mode. This mode is now deprecated. Please read the docs to setup the new MAPS configuration')
+
+    if "IMAGE_PREFIX" in os.environ and os.environ["IMAGE_PREFIX"] != "":
+        image_prefix = os.environ["IMAGE_PREFIX"]
     else:
+        app.logger.warning('The "IMAGESWAP_PREFIX" is empty, skipping swap.')
+        return SwapDecision(image, None, "legacy", None)
 
-        app.logger.warning('ImageSwap Webhook running in "LEGACY" mode. This mode is now deprecated. Please read the docs to setup the new MAPS configuration')
+    app.logger.debug("Swapping image definition for container spec: %s", name)
 
-        if "IMAGE_PREFIX" in os.environ and os.environ["IMAGE_PREFIX"] != "":
-            image_prefix = os.environ["IMAGE_PREFIX"]
-        else:
-            app.logger.warning('The "IMAGESWAP_PREFIX" is empty, skipping swap.')
-            return False
+    if image_prefix in image:
 
-        app.logger.info(f"Swapping image definition for container spec: {name}")
+        app.logger.debug("Internal image definition detected, nothing to do")
+        return SwapDecision(image, None, "legacy", image_prefix)
 
-        if image_prefix in image:
+    if image_prefix[-1] == "-":
+        new_image = image_prefix + image
+    elif "/" not in image:
+        new_image = image_prefix + re.sub(r"(^.*)", r"/\1", image)
+    else:
+        new_image = image_prefix + re.sub(r"(^.*/)+(.*)", r"/\2", image)
 
-            app.logger.info("Internal image definition detected, nothing to do")
-            return False
+    return SwapDecision(image, new_image, "legacy", image_prefix)
 
-        else:
 
-            if image_prefix[-1] == "-":
-                new_image = image_prefix + image
-            elif "/" not in image:
-                new_image = image_prefix + re.sub(r"(^.*)", r"/\1", image)
-            else:
-                new_image = image_prefix + re.sub(r"(^.*/)+(.*)", r"/\2", image)
+def evaluate_container(container_spec, compiled_maps=None):
+
+    """Function to return the imageswap decision for a container spec without modifying it"""
+
+    # Check the imageswap mode
+    if imageswap_mode.lower() == "maps":
 
-    app.logger.info(f"External image definition detected: {image}")
-    app.logger.info(f"External image updated to Internal image: {new_image}")
+        app.logger.debug('ImageSwap Webhook running in "MAPS" mode')
 
-    container_spec["image"] = new_image
+        return lookup_image(container_spec["image"], compiled_maps)
+
+    return legacy_image(container_spec["name"], container_spec["image"])
+
+
+def evaluate_images(images, compiled_maps=None):
+
+    """Function to return the imageswap decision for each image in a list, in the same order
+
+    Every distinct image is evaluated once against a single version of the maps. The
+    decision cache is skipped, so a bulk evaluation doesn't evict the decisions used
+    by admissions.
+    """
+
+    if imageswap_mode.lower() == "maps":
+        if compiled_maps is None:
+            compiled_maps = get_swap_maps(imageswap_maps_file)
+        decisions = {image: map_image(image, compiled_maps) for image in dict.fromkeys(images)}
+    else:
+        decisions = {image: legacy_image("evaluate", image) for image in dict.fromkeys(images)}
+
+    return [decisions[image] for image in images]
+
+
+def swap_image(container_spec):
+
+    """Function to perform imageswap for a container spec"""
+
+    decision = evaluate_container(container_spec)
+
+    if decision.new_image is None:
+        return False
+
+    app.logger.debug("External image definition detected: %s", decision.image)
+    app.logger.debug("External image updated to Internal image: %s", decision.new_image)
+
+    container_spec["image"] = decision.new_image
 
     return True
 
 
+def patch_images(decisions):
+
+    """Function to return JSONPatch operations for a list of (image path, decision) pairs"""
+
+    # A swap to the same image doesn't need a patch operation
+    return [
+        {"op": "replace", "path": image_path, "value": decision.new_image}
+        for (image_path, decision) in decisions
+        if decision.new_image is not None and decision.new_image != decision.image
+    ]
+
+
 ################################################################################
 ################################################################################
 ################################################################################
@@ -431,6 +1710,8 @@ def main():
 
     app.logger.info("ImageSwap v1.5.3 Startup")
 
+    start_maps_watcher()
+
     app.run(
         host="0.0.0.0",
         port=5000,
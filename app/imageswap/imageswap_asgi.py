@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+# Copyright 2020 The WebRoot, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# ASGI entry point for ImageSwap. This serves the same routes as the Flask app
+# in imageswap.py on an event loop, so slow clients don't tie up worker threads.
+# Admission reviews are handed to a thread pool, so a worker still reviews
+# several requests at a time.
+# Run with an ASGI server, ie. "gunicorn --config=config.py" with
+# IMAGESWAP_SERVER_MODE=ASGI, or "uvicorn imageswap_asgi:app".
+
+from prometheus_client import Histogram, make_asgi_app
+import asyncio
+import json
+import time
+import urllib.parse
+
+import imageswap
+import profiling
+
+# Request metrics for the ASGI app. The Flask request metrics from
+# prometheus_flask_exporter are only recorded for the WSGI app.
+asgi_request_duration = Histogram(
+    "imageswap_asgi_http_request_duration_seconds",
+    "ASGI HTTP request duration in seconds",
+    ["method", "path", "status"],
+)
+
+# Serve the same registry as the Flask app, which aggregates every worker in multiprocess mode
+metrics_app = make_asgi_app(imageswap.metrics.registry)
+
+################################################################################
+################################################################################
+################################################################################
+
+
+async def app(scope, receive, send):
+
+    """ASGI application for the ImageSwap webhook"""
+
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+
+    if scope["type"] != "http":
+        return
+
+    path = scope["path"]
+    method = scope["method"]
+    start_time = time.perf_counter()
+
+    if path == "/metrics":
+        await metrics_app(scope, receive, send)
+        return
+
+    # Swapping images is CPU bound, so it runs on the default executor's threads (as the
+    # gthread workers do for the WSGI app) and the event loop keeps serving other requests
+    if path == "/" and method == "POST":
+        request_body = await read_body(receive)
+        loop = asyncio.get_running_loop()
+        (status, response_body, content_type) = await loop.run_in_executor(None, imageswap.review_admission, request_body)
+    elif path == "/v1/evaluate" and method == "POST":
+        request_body = await read_body(receive)
+        loop = asyncio.get_running_loop()
+        (status, response_body, content_type) = await loop.run_in_executor(None, imageswap.evaluate_request, request_body)
+    elif path == "/healthz" and method == "GET":
+        (status, response_body, content_type) = (200, json.dumps(imageswap.health_info()).encode(), "application/json")
+    elif path == "/debug/profile" and method == "POST":
+        # Profiling waits for the session to end, so it runs off the event loop
+        args = dict(urllib.parse.parse_qsl(scope.get("query_string", b"").decode()))
+        authorization = dict(scope["headers"]).get(b"authorization", b"").decode("latin-1")
+        loop = asyncio.get_running_loop()
+        (status, response_body, content_type) = await loop.run_in_executor(None, profiling.profile_request, args, authorization)
+    elif path in ("/", "/v1/evaluate", "/healthz", "/debug/profile"):
+        (status, response_body, content_type) = (405, b"Method Not Allowed", "text/plain")
+    else:
+        (status, response_body, content_type) = (404, b"Not Found", "text/plain")
+
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (b"content-type", content_type.encode()),
+                (b"content-length", str(len(response_body)).encode()),
+            ],
+        }
+    )
+    await send({"type": "http.response.body", "body": response_body})
+
+    if status != 404:
+        asgi_request_duration.labels(method, path, status).observe(time.perf_counter() - start_time)
+
+
+async def read_body(receive):
+
+    """Function to read the full request body from an ASGI receive channel"""
+
+    chunks = []
+
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            break
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body", False):
+            break
+
+    return b"".join(chunks)
+
+
+async def lifespan(receive, send):
+
+    """Function to handle ASGI lifespan events"""
+
+    while True:
+        message = await receive()
+
+        if message["type"] == "lifespan.startup":
+            imageswap.app.logger.info("ImageSwap ASGI Startup")
+            imageswap.start_maps_watcher()
+            await send({"type": "lifespan.startup.complete"})
+
+        elif message["type"] == "lifespan.shutdown":
+            imageswap.stop_maps_watcher()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+
+# Copyright 2020 The WebRoot, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Offline manifest rewriter for ImageSwap. Applies the same swaps as the webhook
+# to multi-document YAML/JSON manifests (ie. Helm or Kustomize output), so the
+# webhook has nothing left to patch at admission time.
+#
+# Documents are read and written one at a time, so memory use doesn't grow with
+# the size of the stream. Only the image lines of a changed document are rewritten,
+# which keeps comments and formatting intact. Documents that aren't changed are
+# written back exactly as they were read.
+#
+# Usage:
+#   helm template ./chart | imageswap_rewrite.py > manifests.yaml
+#   imageswap_rewrite.py deploy.yaml service.yaml > manifests.yaml
+#   imageswap_rewrite.py --in-place ./gitops-repo       # rewrite a directory tree across a process pool
+#   imageswap_rewrite.py --check ./gitops-repo          # exit 1 if any manifest would be changed
+
+import argparse
+import concurrent.futures
+import json
+import os
+import re
+import sys
+import tempfile
+
+# PyYAML is optional, without it only JSON manifests can be rewritten
+try:
+    import yaml
+
+    YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+except ImportError:
+    yaml = None
+
+import imageswap
+
+MANIFEST_EXTENSIONS = (".yaml", ".yml", ".json")
+
+################################################################################
+################################################################################
+################################################################################
+
+
+def configure(maps_file=None, mode=None, log_level="WARNING"):
+
+    """Function to configure the swap logic, in this process or a pool worker"""
+
+    if maps_file:
+        imageswap.imageswap_maps_file = maps_file
+    if mode:
+        imageswap.imageswap_mode = mode
+
+    # The per swap DEBUG lines of the webhook would drown out the rewritten manifests
+    imageswap.app.logger.setLevel(log_level)
+
+
+def rewrite_object(workload_object):
+
+    """Function to swap the images of a manifest in place and return the (old image, new image) pairs that changed"""
+
+    if not isinstance(workload_object, dict):
+        return []
+
+    kind = workload_object.get("kind")
+
+    # Lists (ie. "kubectl get -o yaml" output) are rewritten item by item
+    if isinstance(kind, str) and kind.endswith("List") and isinstance(workload_object.get("items"), list):
+        return [change for item in workload_object["items"] for change in rewrite_object(item)]
+
+    try:
+        if swap_disabled(workload_object, kind):
+            return []
+        containers = imageswap.locate_containers(workload_object, kind)
+    except AttributeError:
+        # Something other than a workload that happens to have a "spec"
+        return []
+
+    changes = []
+
+    for (_, container_spec) in containers:
+        image = container_spec.get("image") if isinstance(container_spec, dict) else None
+        if isinstance(image, str) and imageswap.swap_image(container_spec) and container_spec["image"] != image:
+            changes.append((image, container_spec["image"]))
+
+    return changes
+
+
+def swap_disabled(workload_object, kind):
+
+    """Function to check for the disable label on a workload or its pod template
+
+    The webhook checks the labels of the pods it admits, which come from the pod template.
+    """
+
+    template_path = imageswap.POD_SPEC_PATHS.get(kind, imageswap.DEFAULT_POD_SPEC_PATH)[:-1]
+
+    for path in ((), template_path):
+        metadata = workload_object
+        for key in path + ("metadata",):
+            metadata = metadata.get(key) or {}
+        if (metadata.get("labels") or {}).get(imageswap.imageswap_disable_label) == "disabled":
+            return True
+
+    return False
+
+
+def substitute_images(text, changes):
+
+    """Function to replace the values of the "image" keys in the text of a manifest"""
+
+    for (image, new_image) in dict(changes).items():
+        pattern = r"""((?:^|[{,\s])["']?image["']?[ \t]*:[ \t]*)(["']?)""" + re.escape(image) + r"""\2(?=[ \t]*(?:[,}\r\n#]|$))"""
+        text = re.sub(pattern, lambda match: match.group(1) + match.group(2) + new_image + match.group(2), text, flags=re.MULTILINE)
+
+    return text
+
+
+def split_documents(lines):
+
+    """Function to split a stream of YAML lines into the text of each document"""
+
+    document = []
+
+    for line in lines:
+        if document and (line.rstrip("\r\n") == "---" or line.startswith("--- ")):
+            yield "".join(document)
+            document = []
+        document.append(line)
+
+    if document:
+        yield "".join(document)
+
+
+def load_document(text, output_format):
+
+    """Function to parse the text of a single YAML or JSON document"""
+
+    if output_format == "json":
+        return json.loads(text) if text.strip() else None
+
+    return yaml.load(text, Loader=YamlLoader)
+
+
+def dump_document(workload_object, text, output_format):
+
+    """Function to serialize a rewritten document that couldn't be rewritten line by line"""
+
+    if output_format == "json":
+        return json.dumps(workload_object, indent=2) + "\n"
+
+    separator = "---\n" if text.startswith("---") else ""
+
+    return separator + yaml.safe_dump(workload_object, sort_keys=False, default_flow_style=False)
+
+
+def rewrite_document(text, output_format):
+
+    """Function to rewrite the text of a single document and return the (text, changed, error) of the result"""
+
+    try:
+        workload_object = load_document(text, output_format)
+    except ValueError as e:
+        return (text, False, str(e))
+    except Exception as e:
+        if yaml is not None and isinstance(e, yaml.YAMLError):
+            return (text, False, str(e).replace("\n", " "))
+        raise
+
+    changes = rewrite_object(workload_object)
+
+    if not changes:
+        return (text, False, None)
+
+    # Only keep the line by line rewrite if it parses back to the same manifest
+    new_text = substitute_images(text, changes)
+
+    if load_document(new_text, output_format) != workload_object:
+        new_text = dump_document(workload_object, text, output_format)
+
+    return (new_text, True, None)
+
+
+def rewrite_stream(input_stream, write, output_format="yaml", name="<stdin>"):
+
+    """Function to rewrite every document of a stream and return the number of (documents, changed documents, errors)"""
+
+    documents = changed = errors = 0
+
+    # A JSON manifest is a single document
+    texts = ["".join(input_stream)] if output_format == "json" else split_documents(input_stream)
+
+    for text in texts:
+        (new_text, document_changed, error) = rewrite_document(text, output_format)
+        if error is not None:
+            errors += 1
+            imageswap.app.logger.error(f"Unable to parse document {documents + 1} of {name}, leaving it unchanged: {error}")
+        documents += 1
+        changed += document_changed
+        write(new_text)
+
+    return (documents, changed, errors)
+
+
+def manifest_format(path, first_line=""):
+
+    """Function to return the format ("yaml" or "json") of a manifest from its path or first line"""
+
+    if path.endswith(".json") or first_line.lstrip().startswith(("{", "[")):
+        return "json"
+
+    return "yaml"
+
+
+def rewrite_file(path, in_place=True, check=False):
+
+    """Function to rewrite a manifest file and return the (path, documents, changed documents, errors) of the result
+
+    With "in_place" the file is only replaced when a document changed, through a temporary
+    file in the same directory so a failure never leaves a partially written manifest.
+    Otherwise the rewritten documents are written to stdout.
+    """
+
+    output_format = manifest_format(path)
+
+    if output_format == "yaml" and yaml is None:
+        imageswap.app.logger.error(f"PyYAML is required to rewrite YAML manifests, skipping {path}")
+        return (path, 0, 0, 1)
+
+    with open(path, "r") as input_file:
+
+        if check or not in_place:
+            write = (lambda text: None) if check else sys.stdout.write
+            return (path,) + rewrite_stream(input_file, write, output_format, path)
+
+        (fd, tmp_path) = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=".imageswap-")
+        try:
+            with os.fdopen(fd, "w") as output_file:
+                result = rewrite_stream(input_file, output_file.write, output_format, path)
+            if result[1]:
+                os.chmod(tmp_path, os.stat(path).st_mode & 0o7777)
+                os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    return (path,) + result
+
+
+def find_manifests(paths):
+
+    """Function to expand files and directory trees into a sorted list of manifest files"""
+
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for (root, dirs, files) in os.walk(path):
+            # Skip hidden directories, ie. ".git"
+            dirs[:] = sorted(name for name in dirs if not name.startswith("."))
+            for name in sorted(files):
+                if name.endswith(MANIFEST_EXTENSIONS) and not name.startswith("."):
+                    yield os.path.join(root, name)
+
+
+def rewrite_files(paths, in_place=True, check=False, jobs=None, maps_file=None, mode=None, log_level="WARNING"):
+
+    """Function to rewrite manifest files across a process pool and return the results in order"""
+
+    files = list(find_manifests(paths))
+
+    if jobs == 1 or len(files) < 2:
+        return [rewrite_file(path, in_place, check) for path in files]
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=configure, initargs=(maps_file, mode, log_level)) as executor:
+        return list(executor.map(rewrite_file, files, [in_place] * len(files), [check] * len(files), chunksize=8))
+
+
+################################################################################
+################################################################################
+################################################################################
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description="Apply ImageSwap maps to Kubernetes manifests")
+    parser.add_argument("paths", nargs="*", help='manifest files or directory trees, "-" or nothing reads from stdin')
+    parser.add_argument("-i", "--in-place", action="store_true", help="rewrite the files in place (required for directories)")
+    parser.add_argument("--check", action="store_true", help="don't write anything, exit 1 if any manifest would be changed")
+    parser.add_argument("--format", choices=["auto", "yaml", "json"], default="auto", help="format of the manifests read from stdin")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="worker processes for files and directories (default: one per CPU)")
+    parser.add_argument("--maps-file", default=os.getenv("IMAGESWAP_MAPS_FILE"), help="ImageSwap maps file (default: $IMAGESWAP_MAPS_FILE)")
+    parser.add_argument("--mode", default=None, help="ImageSwap mode, MAPS or LEGACY (default: $IMAGESWAP_MODE)")
+    parser.add_argument("-v", "--verbose", action="store_true", help="log every swap to stderr")
+    args = parser.parse_args(argv)
+
+    log_level = "DEBUG" if args.verbose else "WARNING"
+    configure(args.maps_file, args.mode, log_level)
+
+    paths = [path for path in args.paths if path != "-"]
+
+    if len(paths) < len(args.paths) or not args.paths:
+        output_format = args.format
+        if output_format == "auto":
+            first_line = sys.stdin.readline()
+            output_format = manifest_format("", first_line)
+            input_stream = _prepend(first_line, sys.stdin)
+        else:
+            input_stream = sys.stdin
+        if output_format == "yaml" and yaml is None:
+            parser.error("PyYAML is required to rewrite YAML manifests")
+        write = (lambda text: None) if args.check else sys.stdout.write
+        results = [("<stdin>",) + rewrite_stream(input_stream, write, output_format)]
+    elif any(os.path.isdir(path) for path in paths) and not (args.in_place or args.check):
+        parser.error("directories can only be rewritten with --in-place or --check")
+    else:
+        # Output to stdout keeps the files in order, so they are rewritten one by one
+        jobs = args.jobs if (args.in_place or args.check) else 1
+        results = rewrite_files(paths, args.in_place, args.check, jobs, args.maps_file, args.mode, log_level)
+
+    changed = [path for (path, _, changed_documents, _) in results if changed_documents]
+    errors = sum(result[3] for result in results)
+
+    if args.check:
+        for path in changed:
+            print(f"{path}: images would be swapped", file=sys.stderr)
+    elif args.in_place:
+        print(f"Rewrote {len(changed)} of {len(results)} manifest files", file=sys.stderr)
+
+    if errors:
+        return 2
+
+    return 1 if args.check and changed else 0
+
+
+def _prepend(line, stream):
+
+    """Function to yield a line that was already read from a stream, then the rest of the stream"""
+
+    yield line
+    yield from stream
+
+
+if __name__ == "__main__":
+
+    sys.exit(main())
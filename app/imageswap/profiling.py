@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+
+# Copyright 2020 The WebRoot, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# On-demand profiling for the ImageSwap webhook. A profiling session covers the
+# next N seconds or N admissions of the process that receives the request and
+# returns one of:
+#
+#   cprofile: deterministic profile of the admissions, as pstats text (or a raw pstats dump)
+#   sampling: stacks of the admission threads sampled at a fixed interval, in collapsed
+#             stack format (one "frame;frame;frame count" line per stack, for flamegraph.pl
+#             or speedscope)
+#   memory:   tracemalloc snapshot of the allocations made during the session, grouped by line
+
+import cProfile
+import collections
+import hmac
+import io
+import marshal
+import os
+import pstats
+import sys
+import threading
+import tracemalloc
+
+imageswap_profiling_token = os.getenv("IMAGESWAP_PROFILING_TOKEN", "")
+
+MODES = ("cprofile", "sampling", "memory")
+MAX_SECONDS = 300
+SAMPLE_INTERVAL = 0.005
+
+# Only stacks running code from the app directory are kept by the sampling profiler,
+# so idle server threads don't drown out the admissions
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class ProfileSession:
+
+    """Class to collect a profile of the admissions handled while it is active"""
+
+    def __init__(self, mode, seconds, admissions=0):
+
+        self.mode = mode
+        self.seconds = seconds
+        self.admissions = admissions
+        self.admissions_seen = 0
+        self.admissions_skipped = 0
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+        self.profiler_lock = threading.Lock()
+        self.stats = None
+        self.stacks = collections.Counter()
+        self.snapshot = None
+        self.sampler = None
+        self.owner = None
+
+    def run(self, function, *args):
+
+        """Method to call an admission function, profiling it in cprofile mode
+
+        Only one profiler can be active at a time (per process on Python 3.12+), so in
+        cprofile mode admissions that overlap a profiled admission run unprofiled.
+        """
+
+        if self.done.is_set():
+            return function(*args)
+
+        try:
+            if self.mode == "cprofile" and self.profiler_lock.acquire(blocking=False):
+                try:
+                    return self.profile(function, *args)
+                finally:
+                    self.profiler_lock.release()
+
+            if self.mode == "cprofile":
+                with self.lock:
+                    self.admissions_skipped += 1
+
+            return function(*args)
+        finally:
+            with self.lock:
+                self.admissions_seen += 1
+                if self.admissions and self.admissions_seen >= self.admissions:
+                    self.done.set()
+
+    def profile(self, function, *args):
+
+        """Method to call an admission function under cProfile and add it to the stats of the session"""
+
+        profile = cProfile.Profile()
+
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiling tool (ie. a debugger or coverage) is already active
+            with self.lock:
+                self.admissions_skipped += 1
+            return function(*args)
+
+        try:
+            return function(*args)
+        finally:
+            profile.disable()
+            stats = pstats.Stats(profile)
+            with self.lock:
+                if self.stats is None:
+                    self.stats = stats
+                else:
+                    self.stats.add(stats)
+
+    def sample(self, interval=SAMPLE_INTERVAL):
+
+        """Method to sample the stacks of the threads running app code until the session is done"""
+
+        ignored_threads = {threading.get_ident(), self.owner}
+        app_files = {}
+
+        while not self.done.wait(interval):
+            for (thread_id, frame) in sys._current_frames().items():
+                if thread_id in ignored_threads:
+                    continue
+                stack = []
+                in_app = False
+                while frame is not None:
+                    code = frame.f_code
+                    if code.co_filename not in app_files:
+                        path = os.path.abspath(code.co_filename)
+                        app_files[code.co_filename] = os.path.dirname(path) == APP_DIR and path != os.path.abspath(__file__)
+                    in_app = in_app or app_files[code.co_filename]
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                if in_app:
+                    self.stacks[";".join(reversed(stack))] += 1
+
+    def start(self):
+
+        """Method to start collecting the profile"""
+
+        self.owner = threading.get_ident()
+
+        if self.mode == "sampling":
+            self.sampler = threading.Thread(target=self.sample, name="imageswap-profiler", daemon=True)
+            self.sampler.start()
+        elif self.mode == "memory":
+            tracemalloc.start(25)
+
+    def finish(self):
+
+        """Method to wait for the end of the session and stop collecting the profile"""
+
+        self.done.wait(self.seconds)
+        self.done.set()
+
+        if self.mode == "sampling":
+            self.sampler.join()
+        elif self.mode == "memory":
+            self.snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+            tracemalloc.stop()
+
+    def report(self, output_format="text", top=50):
+
+        """Method to return the (body, content type) of the collected profile"""
+
+        header = f"# {self.mode} profile of {self.admissions_seen} admissions\n"
+
+        if self.admissions_skipped:
+            header += f"# {self.admissions_skipped} admissions overlapped a profiled admission and ran unprofiled\n"
+
+        if self.mode == "cprofile":
+            if self.stats is None:
+                return ((header + "# no admissions were profiled\n").encode(), "text/plain")
+            if output_format == "raw":
+                # Same format as pstats.Stats.dump_stats(), for snakeviz and friends
+                return (marshal.dumps(self.stats.stats), "application/octet-stream")
+            output = io.StringIO()
+            self.stats.stream = output
+            self.stats.sort_stats("cumulative").print_stats(top)
+            return ((header + output.getvalue()).encode(), "text/plain")
+
+        if self.mode == "sampling":
+            lines = [f"{stack} {count}" for (stack, count) in self.stacks.most_common()]
+            return ("\n".join(lines).encode() + b"\n", "text/plain")
+
+        lines = [str(statistic) for statistic in self.snapshot.statistics("lineno")[:top]]
+        return ((header + "\n".join(lines) + "\n").encode(), "text/plain")
+
+
+# The current profiling session, only one can run at a time
+active_session = None
+_session_lock = threading.Lock()
+
+
+def run_admission(function, *args):
+
+    """Function to call an admission function, as part of the active profiling session if there is one"""
+
+    session = active_session
+
+    if session is None:
+        return function(*args)
+
+    return session.run(function, *args)
+
+
+def authorized(authorization):
+
+    """Function to check the "Authorization: Bearer <token>" header of a profiling request"""
+
+    if not imageswap_profiling_token or not authorization or not authorization.startswith("Bearer "):
+        return False
+
+    return hmac.compare_digest(authorization[len("Bearer ") :].encode(), imageswap_profiling_token.encode())
+
+
+def profile_request(args, authorization):
+
+    """Function to run a profiling session for a request and return the (status, body, content type) of the response
+
+    "args" holds the query parameters: mode (cprofile, sampling or memory), seconds (the
+    maximum duration, default 10), admissions (stop after this many admissions), format
+    (text or raw for cprofile) and top (number of entries for cprofile and memory).
+    """
+
+    global active_session
+
+    if not imageswap_profiling_token:
+        return (404, b"Not Found", "text/plain")
+
+    if not authorized(authorization):
+        return (401, b"Unauthorized", "text/plain")
+
+    try:
+        mode = args.get("mode", "cprofile")
+        seconds = min(float(args.get("seconds", "10")), MAX_SECONDS)
+        admissions = int(args.get("admissions", "0"))
+        top = int(args.get("top", "50"))
+        if mode not in MODES or not seconds > 0 or admissions < 0 or top <= 0:
+            raise ValueError(mode)
+    except ValueError:
+        return (400, b"Invalid profiling parameters", "text/plain")
+
+    session = ProfileSession(mode, seconds, admissions)
+
+    with _session_lock:
+        if active_session is not None:
+            return (409, b"A profiling session is already running", "text/plain")
+        session.start()
+        active_session = session
+
+    try:
+        session.finish()
+    finally:
+        active_session = None
+
+    return (200,) + session.report(args.get("format", "text"), top)
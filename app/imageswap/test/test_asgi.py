@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+# Copyright 2020 The WebRoot, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import json
+import sys
+import unittest
+from unittest.mock import patch
+
+sys.path.append("./app/imageswap")
+import imageswap
+import imageswap_asgi
+
+###########################################################################
+# Test ASGI app ###########################################################
+###########################################################################
+
+
+def call_asgi(method, path, body=b"", chunk_size=None):
+
+    """Function to call the ASGI app and return the (status, headers, body) of the response"""
+
+    if chunk_size is None:
+        chunk_size = max(len(body), 1)
+
+    chunks = [body[i : i + chunk_size] for i in range(0, len(body), chunk_size)] or [b""]
+    messages = [{"type": "http.request", "body": chunk, "more_body": i < len(chunks) - 1} for (i, chunk) in enumerate(chunks)]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": method, "path": path, "headers": [], "query_string": b""}
+    asyncio.run(imageswap_asgi.app(scope, receive, send))
+
+    return (sent[0]["status"], dict(sent[0]["headers"]), b"".join(message.get("body", b"") for message in sent[1:]))
+
+
+class AsgiRoutes(unittest.TestCase):
+    def test_asgi_healthz(self):
+
+        """Method to test healthz route on the ASGI app"""
+
+        with patch("imageswap.imageswap_pod_name", "imageswap-abc1234"):
+            (status, headers, body) = call_asgi("GET", "/healthz")
+
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)["health"], "ok")
+        self.assertEqual(json.loads(body)["pod_name"], "imageswap-abc1234")
+
+    def test_asgi_root_matches_wsgi(self):
+
+        """Method to test root route on the ASGI app returns the same response as the WSGI app"""
+
+        with open("./testing/pods/test-pod04.json", "rb") as json_file:
+
+            request_body = json_file.read()
+
+        (status, headers, body) = call_asgi("POST", "/", request_body, chunk_size=1024)
+
+        client = imageswap.app.test_client()
+        result = client.post("/", data=request_body, headers={"Content-Type": "application/json"})
+
+        self.assertEqual(status, 200)
+        self.assertEqual(headers[b"content-type"], b"application/json")
+        self.assertEqual(json.loads(body), json.loads(result.data))
+
+    def test_asgi_evaluate_matches_wsgi(self):
+
+        """Method to test evaluate route on the ASGI app returns the same response as the WSGI app"""
+
+        request_body = json.dumps({"images": ["nginx", "quay.io/solo/gloo:v1.0", "jmsearcy/internal:1.0"]}).encode()
+
+        (status, headers, body) = call_asgi("POST", "/v1/evaluate", request_body)
+
+        client = imageswap.app.test_client()
+        result = client.post("/v1/evaluate", data=request_body, headers={"Content-Type": "application/json"})
+
+        self.assertEqual(status, 200)
+        self.assertEqual(headers[b"content-type"], b"application/json")
+        self.assertEqual(json.loads(body), json.loads(result.data))
+        self.assertEqual(call_asgi("GET", "/v1/evaluate")[0], 405)
+
+    def test_asgi_metrics(self):
+
+        """Method to test metrics route on the ASGI app"""
+
+        (status, headers, body) = call_asgi("GET", "/metrics")
+
+        self.assertEqual(status, 200)
+        self.assertIn(b"imageswap_decision_cache_hits_total", body)
+
+    def test_asgi_unknown_route(self):
+
+        """Method to test unknown routes and methods on the ASGI app"""
+
+        self.assertEqual(call_asgi("GET", "/nope")[0], 404)
+        self.assertEqual(call_asgi("GET", "/")[0], 405)
+
+    @patch("profiling.imageswap_profiling_token", "s3cr3t")
+    def test_asgi_profile_unauthorized(self):
+
+        """Method to test the profiling route on the ASGI app requires the token"""
+
+        self.assertEqual(call_asgi("POST", "/debug/profile")[0], 401)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+
+# Copyright 2020 The WebRoot, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.append("./app/imageswap")
+import config
+
+MIB = 1024 * 1024
+
+###########################################################################
+# Test worker topology ####################################################
+###########################################################################
+
+
+class WorkerTopology(unittest.TestCase):
+    def setUp(self):
+
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cgroup_root = self.tmp_dir.name
+
+    def tearDown(self):
+
+        self.tmp_dir.cleanup()
+
+    def write_cgroup_file(self, path, content):
+
+        """Method to write a fake cgroup file"""
+
+        path = os.path.join(self.cgroup_root, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(content + "\n")
+
+    def test_cgroup_v2_limits(self):
+
+        """Method to test reading the CPU and memory limits from cgroup v2"""
+
+        self.write_cgroup_file("cpu.max", "250000 100000")
+        self.write_cgroup_file("memory.max", str(512 * MIB))
+
+        self.assertEqual(config.cgroup_cpu_limit(self.cgroup_root), 2.5)
+        self.assertEqual(config.cgroup_memory_limit(self.cgroup_root), 512 * MIB)
+
+    def test_cgroup_v2_unlimited(self):
+
+        """Method to test unlimited cgroup v2 limits"""
+
+        self.write_cgroup_file("cpu.max", "max 100000")
+        self.write_cgroup_file("memory.max", "max")
+
+        self.assertIsNone(config.cgroup_cpu_limit(self.cgroup_root))
+        self.assertIsNone(config.cgroup_memory_limit(self.cgroup_root))
+
+    def test_cgroup_v1_limits(self):
+
+        """Method to test reading the CPU and memory limits from cgroup v1"""
+
+        self.write_cgroup_file("cpu,cpuacct/cpu.cfs_quota_us", "50000")
+        self.write_cgroup_file("cpu,cpuacct/cpu.cfs_period_us", "100000")
+        self.write_cgroup_file("memory/memory.limit_in_bytes", str(256 * MIB))
+
+        self.assertEqual(config.cgroup_cpu_limit(self.cgroup_root), 0.5)
+        self.assertEqual(config.cgroup_memory_limit(self.cgroup_root), 256 * MIB)
+
+    def test_cgroup_v1_unlimited(self):
+
+        """Method to test unlimited cgroup v1 limits"""
+
+        self.write_cgroup_file("cpu/cpu.cfs_quota_us", "-1")
+        self.write_cgroup_file("cpu/cpu.cfs_period_us", "100000")
+        self.write_cgroup_file("memory/memory.limit_in_bytes", "9223372036854771712")
+
+        self.assertIsNone(config.cgroup_cpu_limit(self.cgroup_root))
+        self.assertIsNone(config.cgroup_memory_limit(self.cgroup_root))
+
+    def test_no_cgroup(self):
+
+        """Method to test missing cgroup files are treated as unlimited"""
+
+        self.assertIsNone(config.cgroup_cpu_limit(self.cgroup_root))
+        self.assertIsNone(config.cgroup_memory_limit(self.cgroup_root))
+
+    def test_worker_topology(self):
+
+        """Method to test worker and thread counts derived from the limits"""
+
+        # (cpu limit, memory limit, cpus available) -> (workers, threads)
+        cases = [
+            ((0.25, 512 * MIB, 8), (1, 8)),
+            ((0.5, 512 * MIB, 8), (1, 4)),
+            ((0.25, 224 * MIB, 8), (1, 6)),
+            ((2, 512 * MIB, 8), (2, 2)),
+            ((2.5, 512 * MIB, 8), (2, 3)),
+            ((4, 1024 * MIB, 8), (4, 2)),
+            ((4, 1024 * MIB, 2), (2, 2)),
+            ((4, 320 * MIB, 8), (2, 4)),
+            ((4, 256 * MIB, 8), (1, 8)),
+            ((0.5, 128 * MIB, 8), (1, 2)),
+            ((None, None, 3), (3, 2)),
+        ]
+
+        for ((cpu_limit, memory_limit, cpus), expected) in cases:
+            with self.subTest(cpu_limit=cpu_limit, memory_limit=memory_limit, cpus=cpus):
+                self.assertEqual(config.worker_topology(cpu_limit, memory_limit, cpus), expected)
+
+    def test_worker_topology_overrides(self):
+
+        """Method to test the IMAGESWAP_WORKERS and IMAGESWAP_THREADS overrides"""
+
+        self.assertEqual(config.worker_topology(0.5, 512 * MIB, 8, "3", ""), (3, 4))
+        self.assertEqual(config.worker_topology(4, 1024 * MIB, 8, "2", ""), (2, 4))
+
+    def test_worker_topology_invalid_overrides(self):
+
+        """Method to test invalid IMAGESWAP_WORKERS and IMAGESWAP_THREADS overrides raise an error naming the variable"""
+
+        for (workers, threads, name) in [
+            ("0", "", "IMAGESWAP_WORKERS"),
+            ("-1", "", "IMAGESWAP_WORKERS"),
+            ("two", "", "IMAGESWAP_WORKERS"),
+            ("", "0", "IMAGESWAP_THREADS"),
+            ("", "-4", "IMAGESWAP_THREADS"),
+        ]:
+            with self.subTest(workers=workers, threads=threads):
+                with self.assertRaisesRegex(ValueError, name):
+                    config.worker_topology(0.5, 512 * MIB, 8, workers, threads)
+        self.assertEqual(config.worker_topology(0.5, 512 * MIB, 8, "", "8"), (1, 8))
+
+
+if __name__ == "__main__":
+    unittest.main()
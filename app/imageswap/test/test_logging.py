@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+
+# Copyright 2020 The WebRoot, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import logging
+import queue
+import sys
+import unittest
+from prometheus_client import REGISTRY
+from unittest.mock import patch
+
+sys.path.append("./app/imageswap")
+import imageswap
+
+###########################################################################
+# Test queued logging #####################################################
+###########################################################################
+
+
+class CaptureHandler(logging.Handler):
+    def __init__(self):
+
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+
+        self.records.append(record)
+
+
+def capture(logger_name="imageswap"):
+
+    """Function to capture the records the background log writer hands to the handlers of a logger"""
+
+    handler = CaptureHandler()
+
+    return (handler, patch.dict(imageswap._log_listener.routes, {logger_name: [handler]}))
+
+
+class QueuedLogging(unittest.TestCase):
+    def test_records_written_in_background(self):
+
+        """Method to test log records are handed to the original handlers by the writer thread"""
+
+        (handler, capture_records) = capture()
+
+        with capture_records:
+            imageswap.app.logger.warning("queued %s", "record")
+            imageswap._log_listener.queue.join()
+
+        self.assertEqual([record.getMessage() for record in handler.records], ["queued record"])
+
+    def test_full_queue_drops_records(self):
+
+        """Method to test records are dropped and counted instead of blocking when the queue is full"""
+
+        queue_handler = imageswap.DroppingQueueHandler(queue.Queue(1))
+        before = REGISTRY.get_sample_value("imageswap_log_records_dropped_total")
+
+        for i in range(3):
+            queue_handler.handle(logging.makeLogRecord({"msg": f"record {i}"}))
+
+        self.assertEqual(REGISTRY.get_sample_value("imageswap_log_records_dropped_total") - before, 2)
+        self.assertEqual(queue_handler.queue.get_nowait().getMessage(), "record 0")
+
+    def test_restart_after_fork(self):
+
+        """Method to test the writer thread is restarted with a new queue, as it is in a forked child"""
+
+        old_listener = imageswap._log_listener
+        imageswap.stop_queued_logging()
+        imageswap._restart_queued_logging()
+
+        self.assertIsNot(imageswap._log_listener, old_listener)
+        self.assertIs(imageswap._log_queue_handler.queue, imageswap._log_listener.queue)
+
+        (handler, capture_records) = capture()
+
+        with capture_records:
+            imageswap.app.logger.warning("after fork")
+            imageswap._log_listener.queue.join()
+
+        self.assertEqual([record.getMessage() for record in handler.records], ["after fork"])
+
+
+###########################################################################
+# Test audit log ##########################################################
+###########################################################################
+
+
+class AuditLog(unittest.TestCase):
+    def setUp(self):
+
+        self.app = imageswap.app.test_client()
+
+    def admit(self, request_file):
+
+        """Method to post an AdmissionReview and return the audit records logged for it"""
+
+        (handler, capture_records) = capture("imageswap.audit")
+
+        with open(request_file) as json_file:
+
+            request_object = json_file.read()
+
+        with capture_records:
+            result = self.app.post("/", data=request_object, headers={"Content-Type": "application/json"})
+            imageswap._log_listener.queue.join()
+
+        self.assertEqual(result.status_code, 200)
+
+        return [json.loads(record.getMessage()) for record in handler.records]
+
+    def test_audit_patched(self):
+
+        """Method to test a single audit record with every image decision is logged for a patched admission"""
+
+        records = self.admit("./testing/pods/test-pod04.json")
+
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]["uid"], "ffeb2e4a-a440-4f70-90cb-9e960f7471c4")
+        self.assertEqual(records[0]["kind"], "Pod")
+        self.assertEqual(records[0]["outcome"], "patched")
+        self.assertEqual(
+            [(image["path"], image["image"], image["new_image"], image["rule"]) for image in records[0]["images"]],
+            [
+                ("/spec/containers/0/image", "paulbouwer/hello-kubernetes:1.5", "jmsearcy/paulbouwer/hello-kubernetes:1.5", "default"),
+                ("/spec/initContainers/0/image", "paulbouwer/hello-kubernetes:1.5", "jmsearcy/paulbouwer/hello-kubernetes:1.5", "default"),
+            ],
+        )
+        self.assertGreater(records[0]["duration_ms"], 0)
+        self.assertNotIn("sample_rate", records[0])
+
+    def test_audit_sampling(self):
+
+        """Method to test admissions without image changes are sampled, while patched admissions are always logged"""
+
+        with patch("imageswap.imageswap_audit_sample_rate", 0):
+            self.assertEqual(self.admit("./testing/deployments/test-deploy05.json"), [])
+            self.assertEqual(len(self.admit("./testing/pods/test-pod04.json")), 1)
+
+        with patch("imageswap.imageswap_audit_sample_rate", 0.5), patch("imageswap.random.random", return_value=0.1):
+            records = self.admit("./testing/deployments/test-deploy05.json")
+
+        self.assertEqual(records[0]["outcome"], "disabled")
+        self.assertEqual(records[0]["sample_rate"], 0.5)
+
+    def test_audit_log_level(self):
+
+        """Method to test the audit log isn't disabled by a higher IMAGESWAP_LOG_LEVEL"""
+
+        log_level = imageswap.app.logger.level
+        imageswap.app.logger.setLevel("WARNING")
+
+        try:
+            records = self.admit("./testing/pods/test-pod04.json")
+        finally:
+            imageswap.app.logger.setLevel(log_level)
+
+        self.assertEqual(len(records), 1)
+
+    def test_audit_duration(self):
+
+        """Method to test the audit duration is measured from the start of the admission"""
+
+        (handler, capture_records) = capture("imageswap.audit")
+        audit = {"uid": "1234", "namespace": "test1", "workload": "test", "kind": "Pod"}
+
+        with capture_records:
+            imageswap.complete_admission(imageswap.admission_review("1234"), {}, [], audit, [], "unchanged", imageswap.time.perf_counter() - 1)
+            imageswap._log_listener.queue.join()
+
+        self.assertGreaterEqual(json.loads(handler.records[0].getMessage())["duration_ms"], 1000)
+
+
+if __name__ == "__main__":
+    unittest.main()
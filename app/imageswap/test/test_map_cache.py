@@ -0,0 +1,533 @@
+#!/usr/bin/env python
+
+# Copyright 2020 The WebRoot, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import base64
+import json
+import os
+import signal
+import sys
+import tempfile
+import time
+import unittest
+from prometheus_client import REGISTRY
+from unittest.mock import patch
+
+sys.path.append("./app/imageswap")
+import imageswap
+
+###########################################################################
+# Test compiled map cache #################################################
+###########################################################################
+
+
+@patch("imageswap.imageswap_mode", "MAPS")
+@patch("imageswap.imageswap_maps_check_interval", 0)
+class MapCache(unittest.TestCase):
+    def setUp(self):
+
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.map_file = os.path.join(self.tmp_dir.name, "imageswap-maps.conf")
+        self.write_maps("default::default.example.com\n")
+
+    def tearDown(self):
+
+        self.tmp_dir.cleanup()
+
+    def write_maps(self, contents):
+
+        with open(self.map_file, "w") as f:
+            f.write(contents)
+
+        # Force a distinct mtime so the change is detected on coarse grained filesystems
+        stat = os.stat(self.map_file)
+        os.utime(self.map_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+
+    def test_map_cache_reuses_compiled_maps(self):
+
+        """Method to test compiled maps are reused while the map file is unchanged"""
+
+        first = imageswap.get_swap_maps(self.map_file)
+        second = imageswap.get_swap_maps(self.map_file)
+
+        self.assertIs(first, second)
+        self.assertEqual(first.maps["default"], "default.example.com")
+
+    def test_map_cache_rebuilds_on_change(self):
+
+        """Method to test compiled maps are rebuilt when the map file changes"""
+
+        first = imageswap.get_swap_maps(self.map_file)
+        self.write_maps("default::other.example.com\n")
+        second = imageswap.get_swap_maps(self.map_file)
+
+        self.assertIsNot(first, second)
+        self.assertGreater(second.version, first.version)
+        self.assertEqual(second.maps["default"], "other.example.com")
+
+    def test_map_cache_keeps_maps_when_file_missing(self):
+
+        """Method to test previously compiled maps are used when the map file disappears"""
+
+        first = imageswap.get_swap_maps(self.map_file)
+        os.remove(self.map_file)
+
+        self.assertIs(imageswap.get_swap_maps(self.map_file), first)
+
+    def test_map_cache_swap_image(self):
+
+        """Method to test swap_image picks up map file changes"""
+
+        with patch("imageswap.imageswap_maps_file", self.map_file):
+
+            container_spec = {"name": "test-container", "image": "quay.io/solo/gloo:v1.0"}
+            imageswap.swap_image(container_spec)
+            self.assertEqual(container_spec["image"], "default.example.com/solo/gloo:v1.0")
+
+            self.write_maps("default::other.example.com\n")
+
+            container_spec = {"name": "test-container", "image": "quay.io/solo/gloo:v1.0"}
+            imageswap.swap_image(container_spec)
+            self.assertEqual(container_spec["image"], "other.example.com/solo/gloo:v1.0")
+
+
+@patch("imageswap.imageswap_mode", "MAPS")
+class MapsWatcher(unittest.TestCase):
+    def setUp(self):
+
+        # Mimic the layout of a ConfigMap volume, where the map file is a symlink into "..data"
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.map_file = os.path.join(self.tmp_dir.name, "imageswap-maps.conf")
+        self.swap_configmap("default::default.example.com\n", "1")
+        os.symlink(os.path.join("..data", "imageswap-maps.conf"), self.map_file)
+
+    def tearDown(self):
+
+        imageswap.stop_maps_watcher()
+        self.tmp_dir.cleanup()
+
+    def swap_configmap(self, contents, revision, mode="w"):
+
+        revision_dir = os.path.join(self.tmp_dir.name, f"..rev{revision}")
+        os.mkdir(revision_dir)
+
+        with open(os.path.join(revision_dir, "imageswap-maps.conf"), mode) as f:
+            f.write(contents)
+
+        tmp_link = os.path.join(self.tmp_dir.name, "..data_tmp")
+        os.symlink(os.path.basename(revision_dir), tmp_link)
+        os.rename(tmp_link, os.path.join(self.tmp_dir.name, "..data"))
+
+    def test_maps_watcher_reload(self):
+
+        """Method to test the watcher publishes new maps after a ConfigMap symlink swap"""
+
+        watcher = imageswap.MapsWatcher(self.map_file)
+        first = imageswap.get_swap_maps(self.map_file)
+
+        self.assertFalse(watcher.reload())
+
+        self.swap_configmap("default::other.example.com\n", "2")
+
+        self.assertTrue(watcher.reload())
+        second = imageswap.get_swap_maps(self.map_file)
+        self.assertGreater(second.version, first.version)
+        self.assertEqual(second.maps["default"], "other.example.com")
+
+    def test_maps_watcher_keeps_previous_on_invalid(self):
+
+        """Method to test the watcher keeps the last good maps when the new map file is invalid"""
+
+        watcher = imageswap.MapsWatcher(self.map_file)
+        first = imageswap.get_swap_maps(self.map_file)
+
+        self.swap_configmap("# no maps here\n", "2")
+        self.assertFalse(watcher.reload())
+        self.assertIs(imageswap.get_swap_maps(self.map_file), first)
+
+        self.swap_configmap(b"default::\xff\xfe\n", "3", mode="wb")
+        self.assertFalse(watcher.reload())
+        self.assertIs(imageswap.get_swap_maps(self.map_file), first)
+
+    @patch("imageswap.imageswap_maps_watch", True)
+    @patch("imageswap.imageswap_maps_watch_interval", 0.05)
+    def test_maps_watcher_thread(self):
+
+        """Method to test the background watcher picks up a ConfigMap update without a stat on lookup"""
+
+        imageswap.start_maps_watcher(self.map_file)
+        first = imageswap.get_swap_maps(self.map_file)
+
+        self.swap_configmap("default::other.example.com\n", "2")
+
+        deadline = time.monotonic() + 5
+        while imageswap.get_swap_maps(self.map_file) is first and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        self.assertEqual(imageswap.get_swap_maps(self.map_file).maps["default"], "other.example.com")
+
+    @patch("imageswap.imageswap_maps_watch", True)
+    @patch("imageswap.imageswap_maps_watch_interval", 0.05)
+    @patch("imageswap._maps_master_pid", None)
+    def test_master_maps_watcher_signals_reload(self):
+
+        """Method to test a preloaded master reloads its workers with SIGHUP after a ConfigMap update"""
+
+        with patch("imageswap.os.kill") as kill:
+
+            imageswap.start_master_maps_watcher(self.map_file)
+            self.swap_configmap("# no maps here\n", "2")
+            self.swap_configmap("default::other.example.com\n", "3")
+
+            deadline = time.monotonic() + 5
+            while not kill.called and time.monotonic() < deadline:
+                time.sleep(0.01)
+
+        # The invalid revision is skipped, so the workers are only reloaded once for the valid one
+        kill.assert_called_once_with(os.getpid(), signal.SIGHUP)
+        self.assertEqual(imageswap.get_swap_maps(self.map_file).maps["default"], "other.example.com")
+
+    @patch("imageswap.imageswap_maps_watch", True)
+    def test_preloaded_worker_skips_watcher(self):
+
+        """Method to test workers forked from a preloaded master don't start their own watcher"""
+
+        with patch("imageswap._maps_master_pid", os.getpid() + 1):
+            self.assertIsNone(imageswap.start_maps_watcher(self.map_file))
+
+
+@patch("imageswap.imageswap_mode", "MAPS")
+class DecisionCache(unittest.TestCase):
+    def setUp(self):
+
+        self.app = imageswap.app.test_client()
+        self.app.testing = True
+
+    def sample(self, name):
+
+        return REGISTRY.get_sample_value(f"imageswap_decision_cache_{name}_total")
+
+    def test_decision_cache_hit(self):
+
+        """Method to test repeated images are served from the decision cache"""
+
+        swap_maps = imageswap.SwapMaps({}, {}, {"default": "default.example.com"}, version=-1)
+        hits = self.sample("hits")
+        misses = self.sample("misses")
+
+        first = imageswap.lookup_image("quay.io/solo/gloo:v1.0", swap_maps)
+        second = imageswap.lookup_image("quay.io/solo/gloo:v1.0", swap_maps)
+
+        self.assertIs(first, second)
+        self.assertEqual(first.new_image, "default.example.com/solo/gloo:v1.0")
+        self.assertEqual(self.sample("hits"), hits + 1)
+        self.assertEqual(self.sample("misses"), misses + 1)
+
+    def test_decision_cache_version_change(self):
+
+        """Method to test cached decisions are never used for another map version"""
+
+        old_maps = imageswap.SwapMaps({}, {}, {"default": "default.example.com"}, version=-2)
+        new_maps = imageswap.SwapMaps({}, {}, {"default": "other.example.com"}, version=-3)
+
+        self.assertEqual(imageswap.lookup_image("nginx", old_maps).new_image, "default.example.com/nginx")
+        self.assertEqual(imageswap.lookup_image("nginx", new_maps).new_image, "other.example.com/nginx")
+
+    def test_decision_cache_eviction(self):
+
+        """Method to test the decision cache is bounded"""
+
+        cache = imageswap.DecisionCache(2)
+        evictions = self.sample("evictions")
+
+        for image in ["a", "b", "c"]:
+            cache.put(1, image, image)
+
+        self.assertIsNone(cache.get(1, "a"))
+        self.assertEqual(cache.get(1, "c"), "c")
+        self.assertEqual(self.sample("evictions"), evictions + 1)
+
+    def test_decision_cache_metrics(self):
+
+        """Method to test the decision cache counters are exposed on the metrics route"""
+
+        result = self.app.get("/metrics")
+
+        self.assertEqual(result.status_code, 200)
+        self.assertIn(b"imageswap_decision_cache_hits_total", result.data)
+        self.assertIn(b"imageswap_decision_cache_evictions_total", result.data)
+
+
+@patch("imageswap.imageswap_mode", "MAPS")
+class ResponseCache(unittest.TestCase):
+    def setUp(self):
+
+        self.app = imageswap.app.test_client()
+        self.app.testing = True
+
+        with open("./testing/pods/test-pod04.json") as json_file:
+            self.request_object_json = json.load(json_file)
+
+        imageswap.response_cache.clear()
+
+    def tearDown(self):
+
+        imageswap.response_cache.clear()
+
+    def sample(self, cache, name):
+
+        return REGISTRY.get_sample_value(f"imageswap_{cache}_cache_{name}_total")
+
+    def admit(self, uid, image=None):
+
+        """Method to post a copy of the test pod with a new uid (and optionally a new image)"""
+
+        request_object_json = json.loads(json.dumps(self.request_object_json))
+        request_object_json["request"]["uid"] = uid
+        if image is not None:
+            request_object_json["request"]["object"]["spec"]["containers"][0]["image"] = image
+
+        result = self.app.post("/", data=json.dumps(request_object_json), headers={"Content-Type": "application/json"})
+
+        self.assertEqual(result.status_code, 200)
+
+        return json.loads(result.data)["response"]
+
+    @patch.object(imageswap.response_cache, "maxsize", 16)
+    def test_response_cache_hit(self):
+
+        """Method to test replicas of a workload reuse the patch of the first replica with their own uid"""
+
+        first = self.admit("replica-1")
+        hits = self.sample("response", "hits")
+        decision_misses = self.sample("decision", "misses")
+        decision_hits = self.sample("decision", "hits")
+
+        second = self.admit("replica-2")
+
+        self.assertEqual(second["uid"], "replica-2")
+        self.assertEqual(second["patch"], first["patch"])
+        self.assertEqual(self.sample("response", "hits"), hits + 1)
+        # No image was evaluated for the second replica
+        self.assertEqual(self.sample("decision", "misses"), decision_misses)
+        self.assertEqual(self.sample("decision", "hits"), decision_hits)
+
+    @patch.object(imageswap.response_cache, "maxsize", 16)
+    def test_response_cache_images(self):
+
+        """Method to test workloads with different images don't share a response"""
+
+        first = self.admit("replica-1")
+        hits = self.sample("response", "hits")
+
+        second = self.admit("replica-2", image="quay.io/solo/gloo:v1.0")
+        patch_ops = json.loads(base64.b64decode(second["patch"]))
+
+        self.assertNotEqual(second["patch"], first["patch"])
+        self.assertIn({"op": "replace", "path": "/spec/containers/0/image", "value": "jmsearcy/solo/gloo:v1.0"}, patch_ops)
+        self.assertEqual(self.sample("response", "hits"), hits)
+
+    @patch.object(imageswap.response_cache, "maxsize", 16)
+    def test_response_cache_unchanged(self):
+
+        """Method to test responses without a patch are cached too"""
+
+        self.request_object_json["request"]["object"]["spec"]["initContainers"][0]["image"] = "jmsearcy/internal-init:1.0"
+
+        self.admit("replica-1", image="jmsearcy/internal:1.0")
+        hits = self.sample("response", "hits")
+
+        second = self.admit("replica-2", image="jmsearcy/internal:1.0")
+
+        self.assertEqual(second["uid"], "replica-2")
+        self.assertNotIn("patch", second)
+        self.assertEqual(self.sample("response", "hits"), hits + 1)
+
+    def test_response_cache_key(self):
+
+        """Method to test the response cache key covers the kind, image positions and disable label"""
+
+        containers = [("/spec/containers/0/image", {"image": "nginx"}), ("/spec/initContainers/0/image", {"image": "busybox"})]
+        key = imageswap.response_cache_key("Pod", containers, None)
+
+        self.assertEqual(key, imageswap.response_cache_key("Pod", [(path, dict(spec)) for (path, spec) in containers], None))
+        self.assertNotEqual(key, imageswap.response_cache_key("Deployment", containers, None))
+        self.assertNotEqual(key, imageswap.response_cache_key("Pod", containers, "enabled"))
+        self.assertNotEqual(key, imageswap.response_cache_key("Pod", list(reversed(containers)), None))
+
+    def test_response_cache_disabled(self):
+
+        """Method to test nothing is cached by default"""
+
+        self.admit("replica-1")
+        self.admit("replica-2")
+
+        self.assertEqual(len(imageswap.response_cache.entries), 0)
+
+
+@patch("imageswap.imageswap_mode", "MAPS")
+@patch("imageswap.imageswap_maps_check_interval", 0)
+class MapOverlays(unittest.TestCase):
+    def setUp(self):
+
+        self.app = imageswap.app.test_client()
+        self.app.testing = True
+
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.map_file = os.path.join(self.tmp_dir.name, "imageswap-maps.conf")
+        self.overlay_dir = os.path.join(self.tmp_dir.name, "overlays")
+        os.mkdir(self.overlay_dir)
+
+        with open(self.map_file, "w") as f:
+            f.write("default::default.example.com\nquay.io::quay.example.com\n")
+
+        self.write_overlay("10-team-a.conf", "namespaces::team-a, team-b\ndefault::team-a.example.com\n[REPLACE]ghcr.io/team-a/*::ghcr.team-a.example.com\n")
+        self.write_overlay("20-gpu.conf", "selector::accelerator=nvidia\nnvcr.io::gpu.example.com\n")
+        self.write_overlay("30-team-a-web.conf", "namespaces::team-a\nselector::tier=web, accelerator=nvidia\ndefault::web.team-a.example.com\n")
+        self.write_overlay("40-everywhere.conf", "quay.io::\n")
+        # ConfigMap volumes hold their files in hidden directories
+        os.mkdir(os.path.join(self.overlay_dir, "..data"))
+
+    def tearDown(self):
+
+        self.tmp_dir.cleanup()
+
+    def write_overlay(self, name, contents):
+
+        path = os.path.join(self.overlay_dir, name)
+
+        with open(path, "w") as f:
+            f.write(contents)
+
+        # Force a distinct mtime so the change is detected on coarse grained filesystems
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+
+    def view(self, namespace, labels=None):
+
+        return imageswap.get_map_overlays(self.overlay_dir).view(imageswap.get_swap_maps(self.map_file), namespace, labels or {})
+
+    def test_map_overlays_match(self):
+
+        """Method to test overlays are matched by namespace and label selector"""
+
+        overlays = imageswap.get_map_overlays(self.overlay_dir)
+        names = lambda namespace, labels: [overlays.overlays[index].name for index in overlays.match(namespace, labels)]
+
+        # The overlay without a namespace or selector is skipped
+        self.assertEqual(len(overlays.overlays), 3)
+        self.assertEqual(names("default", {}), [])
+        self.assertEqual(names("team-b", {"tier": "web"}), ["10-team-a.conf"])
+        self.assertEqual(names("default", {"accelerator": "nvidia"}), ["20-gpu.conf"])
+        self.assertEqual(names("team-a", {"accelerator": "nvidia"}), ["10-team-a.conf", "20-gpu.conf"])
+        self.assertEqual(names("team-a", {"accelerator": "nvidia", "tier": "web"}), ["10-team-a.conf", "20-gpu.conf", "30-team-a-web.conf"])
+
+    def test_map_overlays_view(self):
+
+        """Method to test the merged view of the global maps and the overlays that apply"""
+
+        base = imageswap.get_swap_maps(self.map_file)
+        team_a = self.view("team-a")
+        web = self.view("team-a", {"tier": "web", "accelerator": "nvidia", "app": "web"})
+
+        self.assertIs(self.view("default"), base)
+        self.assertIs(self.view("team-a", {"app": "other"}), team_a)
+        self.assertIs(self.view("team-b"), self.view("team-b"))
+
+        self.assertEqual(imageswap.map_image("nginx", team_a).new_image, "team-a.example.com/nginx")
+        self.assertEqual(imageswap.map_image("quay.io/solo/gloo:v1.0", team_a).new_image, "quay.example.com/solo/gloo:v1.0")
+        self.assertEqual(imageswap.map_image("ghcr.io/team-a/app:1.0", team_a).new_image, "ghcr.team-a.example.com/app:1.0")
+        self.assertEqual(imageswap.map_image("nginx", web).new_image, "web.team-a.example.com/nginx")
+        self.assertEqual(imageswap.map_image("nvcr.io/nvidia/cuda:11", web).new_image, "gpu.example.com/nvidia/cuda:11")
+        self.assertEqual(imageswap.map_image("nvcr.io/nvidia/cuda:11", base).new_image, "default.example.com/nvidia/cuda:11")
+
+    def test_map_overlays_reload(self):
+
+        """Method to test overlays and their views are rebuilt when an overlay file changes"""
+
+        first = self.view("team-a")
+        self.write_overlay("10-team-a.conf", "namespaces::team-a\ndefault::new.team-a.example.com\n")
+        second = self.view("team-a")
+
+        self.assertIsNot(first, second)
+        self.assertEqual(imageswap.map_image("nginx", second).new_image, "new.team-a.example.com/nginx")
+        self.assertIs(self.view("team-b"), imageswap.get_swap_maps(self.map_file))
+
+    def test_map_overlays_missing_dir(self):
+
+        """Method to test a missing overlay directory leaves the global maps in place"""
+
+        base = imageswap.get_swap_maps(self.map_file)
+        overlays = imageswap.get_map_overlays(os.path.join(self.tmp_dir.name, "missing"))
+
+        self.assertIs(overlays.view(base, "team-a", {}), base)
+
+    def test_map_overlays_admission(self):
+
+        """Method to test admissions are swapped with the maps of their namespace"""
+
+        with open("./testing/pods/test-pod04.json") as json_file:
+            request_object_json = json.load(json_file)
+
+        patches = {}
+
+        with patch("imageswap.imageswap_maps_file", self.map_file), patch("imageswap.imageswap_maps_overlay_dir", self.overlay_dir):
+            for namespace in ["team-a", "default", "team-a"]:
+                request_object_json["request"]["namespace"] = namespace
+                result = self.app.post("/", data=json.dumps(request_object_json), headers={"Content-Type": "application/json"})
+                self.assertEqual(result.status_code, 200)
+                patches.setdefault(namespace, []).append(json.loads(base64.b64decode(json.loads(result.data)["response"]["patch"]))[0]["value"])
+
+        # Decisions cached for one namespace are never used for another
+        self.assertEqual(patches["team-a"], ["team-a.example.com/paulbouwer/hello-kubernetes:1.5"] * 2)
+        self.assertEqual(patches["default"], ["default.example.com/paulbouwer/hello-kubernetes:1.5"])
+
+    def test_map_overlays_evaluate(self):
+
+        """Method to test the evaluate route uses the overlays of the given namespace and labels"""
+
+        body = {"images": ["nginx", "nvcr.io/nvidia/cuda:11"], "namespace": "team-a", "labels": {"accelerator": "nvidia"}}
+
+        with patch("imageswap.imageswap_maps_file", self.map_file), patch("imageswap.imageswap_maps_overlay_dir", self.overlay_dir):
+            result = self.app.post("/v1/evaluate", data=json.dumps(body), headers={"Content-Type": "application/json"})
+
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual([image["new_image"] for image in json.loads(result.data)["images"]], ["team-a.example.com/nginx", "gpu.example.com/nvidia/cuda:11"])
+
+    def test_map_overlays_evaluate_invalid_namespace(self):
+
+        """Method to test the evaluate route rejects a namespace that isn't a string"""
+
+        body = {"images": ["nginx"], "namespace": ["team-a"]}
+
+        with patch("imageswap.imageswap_maps_file", self.map_file), patch("imageswap.imageswap_maps_overlay_dir", self.overlay_dir):
+            result = self.app.post("/v1/evaluate", data=json.dumps(body), headers={"Content-Type": "application/json"})
+
+        self.assertEqual(result.status_code, 400)
+
+    def test_map_overlays_evaluate_invalid_labels(self):
+
+        """Method to test the evaluate route rejects label values that aren't strings"""
+
+        body = {"images": ["nginx"], "namespace": "team-a", "labels": {"accelerator": ["nvidia"]}}
+
+        with patch("imageswap.imageswap_maps_file", self.map_file), patch("imageswap.imageswap_maps_overlay_dir", self.overlay_dir):
+            result = self.app.post("/v1/evaluate", data=json.dumps(body), headers={"Content-Type": "application/json"})
+
+        self.assertEqual(result.status_code, 400)
+
+
+if __name__ == "__main__":
+    unittest.main()
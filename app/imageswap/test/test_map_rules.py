@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+
+# Copyright 2020 The WebRoot, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import fnmatch
+import sys
+import unittest
+from unittest.mock import patch
+
+sys.path.append("./app/imageswap")
+import imageswap
+
+###########################################################################
+# Test compiled map rules #################################################
+###########################################################################
+
+
+class MapRules(unittest.TestCase):
+    def setUp(self):
+
+        self.swap_maps = imageswap.SwapMaps(
+            {},
+            {},
+            {
+                "default": "default.example.com",
+                "docker.io": "my.example.com/mirror-",
+                "docker.io/library": "harbor.example.com/library",
+                "quay.io": "quay.example3.com",
+                "registry.waldo.com:8443": "registry.garply.com",
+                "gitlab.com/library": "harbor.example.com/gitlab",
+                "cool.io": "",
+                "noswap_wildcards": "twr.io",
+            },
+        )
+
+    def test_resolve_registry(self):
+
+        """Method to test registry resolution against the compiled registry index"""
+
+        (key, rule) = self.swap_maps.resolve_registry("quay.io", "quay.io", False)
+        self.assertEqual(key, "quay.io")
+        self.assertEqual(rule.value, "quay.example3.com")
+
+        (key, rule) = self.swap_maps.resolve_registry("quay.io:443", "quay.io", False)
+        self.assertEqual(key, "quay.io")
+
+        (key, rule) = self.swap_maps.resolve_registry("registry.waldo.com:8443", "registry.waldo.com", False)
+        self.assertEqual(key, "registry.waldo.com:8443")
+
+        (key, rule) = self.swap_maps.resolve_registry("docker.io", "docker.io", True)
+        self.assertEqual(key, "docker.io/library")
+
+        (key, rule) = self.swap_maps.resolve_registry("example.com", "example.com", False)
+        self.assertIsNone(rule)
+
+    def test_resolve_registry_library_only(self):
+
+        """Method to test a registry with only a "/library" map doesn't apply to non library images"""
+
+        (key, rule) = self.swap_maps.resolve_registry("gitlab.com", "gitlab.com", False)
+        self.assertIsNone(rule)
+
+        (key, rule) = self.swap_maps.resolve_registry("gitlab.com", "gitlab.com", True)
+        self.assertEqual(rule.value, "harbor.example.com/gitlab")
+
+    def test_map_rule_rewrite(self):
+
+        """Method to test the precomputed rewrite actions of map rules"""
+
+        def rewrite(rule, image, image_registry_key):
+            return rule.rewrite(image, imageswap.parse_image(image), image_registry_key)
+
+        rule = imageswap.MapRule("quay.io", "quay.example3.com")
+        self.assertEqual(rewrite(rule, "quay.io/solo/gloo:v1.0", "quay.io"), "quay.example3.com/solo/gloo:v1.0")
+
+        rule = imageswap.MapRule("docker.io", "my.example.com/mirror-")
+        self.assertTrue(rule.dash)
+        self.assertEqual(rewrite(rule, "nginx:latest", "docker.io"), "my.example.com/mirror-docker.io/nginx:latest")
+
+        # The port is dropped from the registry, but the full path is kept
+        rule = imageswap.MapRule("registry.bar.com:8443", "my.example.com/mirror-")
+        self.assertEqual(
+            rewrite(rule, "registry.bar.com:8443/jmsearcy/twrtools:latest", "registry.bar.com:8443"),
+            "my.example.com/mirror-registry.bar.com/jmsearcy/twrtools:latest",
+        )
+
+        rule = imageswap.MapRule("cool.io", "")
+        self.assertTrue(rule.skip)
+        self.assertIsNone(rewrite(rule, "cool.io/app", "cool.io"))
+
+        rule = imageswap.MapRule("default", "default.example.com", default=True)
+        self.assertEqual(rewrite(rule, "gcr.io:443/istio/istiod", "gcr.io:443"), "default.example.com/istio/istiod")
+        self.assertEqual(rewrite(rule, "jmsearcy/app", "docker.io"), "default.example.com/jmsearcy/app")
+
+    def test_parse_image(self):
+
+        """Method to test parsing image references into registry, port, path, tag and digest"""
+
+        digest = "sha256:15d3b5c4f521a84896ed1ead1b14e4774d02202d5c65ab68f30eeaf310a3b1a7"
+
+        # image -> (registry, port, path, tag, digest, explicit registry)
+        cases = {
+            "nginx": ("docker.io", None, "nginx", None, None, False),
+            "nginx:1.21": ("docker.io", None, "nginx", "1.21", None, False),
+            "jmsearcy/twrtools:latest": ("docker.io", None, "jmsearcy/twrtools", "latest", None, False),
+            "myregistry/app:1.0": ("docker.io", None, "myregistry/app", "1.0", None, False),
+            "quay.io/solo/gloo:v1.0": ("quay.io", None, "solo/gloo", "v1.0", None, True),
+            "registry.bar.com:8443/jmsearcy/twrtools": ("registry.bar.com", "8443", "jmsearcy/twrtools", None, None, True),
+            "localhost/app:dev": ("localhost", None, "app", "dev", None, True),
+            "localhost:5000/foo/bar:1.0": ("localhost", "5000", "foo/bar", "1.0", None, True),
+            "myregistry:5000/app": ("myregistry", "5000", "app", None, None, True),
+            f"kindest/node@{digest}": ("docker.io", None, "kindest/node", None, digest, False),
+            f"gcr.io:443/istio/istiod:1.9@{digest}": ("gcr.io", "443", "istio/istiod", "1.9", digest, True),
+        }
+
+        for (image, expected) in cases.items():
+            with self.subTest(image=image):
+                self.assertEqual(tuple(imageswap.parse_image(image)), expected)
+
+        reference = imageswap.parse_image(f"gcr.io:443/istio/istiod:1.9@{digest}")
+        self.assertEqual(reference.domain, "gcr.io:443")
+        self.assertEqual(reference.unqualified, f"istio/istiod:1.9@{digest}")
+        self.assertFalse(reference.library)
+        self.assertTrue(imageswap.parse_image("nginx:latest").library)
+        self.assertFalse(imageswap.parse_image("localhost:5000/nginx").library)
+
+    def test_swap_image_registry_without_dots(self):
+
+        """Method to test images from registries without a "." (ie. localhost:5000) use the registry map"""
+
+        swap_maps = imageswap.SwapMaps({}, {}, {"default": "default.example.com", "localhost:5000": "mirror.example.com/local"})
+
+        self.assertEqual(imageswap.map_image("localhost:5000/foo/bar:1.0", swap_maps).new_image, "mirror.example.com/local/foo/bar:1.0")
+        self.assertEqual(imageswap.map_image("localhost:5000/foo/bar:1.0", swap_maps).rule, "registry")
+
+    def test_match_replace_first_match(self):
+
+        """Method to test the combined replace pattern regex keeps first-match semantics"""
+
+        replace_maps = {
+            "ghcr.io/public/*": "first.example.com",
+            "ghcr.io/*": "second.example.com",
+            "*redis:?.?": "third.example.com",
+        }
+        swap_maps = imageswap.SwapMaps(replace_maps, {}, {"default": "default.example.com"})
+
+        self.assertEqual(swap_maps.match_replace("ghcr.io/public/app:1.0"), "ghcr.io/public/*")
+        self.assertEqual(swap_maps.match_replace("ghcr.io/private/app:1.0"), "ghcr.io/*")
+        self.assertEqual(swap_maps.match_replace("bitnami/redis:6.2"), "*redis:?.?")
+        self.assertIsNone(swap_maps.match_replace("bitnami/redis:6.2.1"))
+        self.assertIsNone(imageswap.SwapMaps({}, {}, {}).match_replace("ghcr.io/public/app"))
+
+    def test_match_replace_many_patterns(self):
+
+        """Method to test the combined replace pattern regex agrees with fnmatch for many patterns"""
+
+        replace_maps = {f"registry{i}.example.com/team{i % 7}/*": f"mirror{i}.example.com" for i in range(500)}
+        swap_maps = imageswap.SwapMaps(replace_maps, {}, {"default": "default.example.com"})
+
+        for image in ["registry42.example.com/team0/app:1", "registry499.example.com/team2/app", "registry42.example.com/team1/app"]:
+            expected = next((pattern for pattern in replace_maps if fnmatch.fnmatch(image, pattern)), None)
+            self.assertEqual(swap_maps.match_replace(image), expected)
+
+    def test_match_noswap(self):
+
+        """Method to test the compiled noswap wildcard matcher"""
+
+        maps = {"default": "default.example.com", "noswap_wildcards": "twr.io, walrus.io,,example, example.com "}
+        swap_maps = imageswap.SwapMaps({}, {}, maps)
+
+        self.assertEqual(swap_maps.noswap_wildcards, ["twr.io", "walrus.io", "example", "example.com"])
+        self.assertEqual(swap_maps.match_noswap("harbor.geo.k8s.twr.io/stuff/magtape:latest"), "twr.io")
+        self.assertEqual(swap_maps.match_noswap("edge.example.com/image:latest"), "example")
+        self.assertIsNone(swap_maps.match_noswap("quay.io/solo/gloo:v1.0"))
+        self.assertIsNone(imageswap.SwapMaps({}, {}, {"noswap_wildcards": ""}).match_noswap("twr.io/image"))
+
+    def test_match_noswap_many_wildcards(self):
+
+        """Method to test the compiled noswap wildcard matcher agrees with a substring scan for many wildcards"""
+
+        wildcards = [f"internal{i}.corp.example.com" for i in range(300)] + ["twr.io", "walrus.io"]
+        swap_maps = imageswap.SwapMaps({}, {}, {"noswap_wildcards": ",".join(wildcards)})
+
+        for image in ["x.internal77.corp.example.com/app", "internal3.corp.example.co/app", "walrus.io/app", "docker.io/library/nginx"]:
+            self.assertEqual(swap_maps.match_noswap(image) is not None, any(wildcard in image for wildcard in wildcards))
+
+    @patch("imageswap.imageswap_mode", "MAPS")
+    def test_swap_image_library_only_map(self):
+
+        """Method to test a non library image falls back to the default map when only a "/library" map exists"""
+
+        with patch("imageswap.get_swap_maps", return_value=self.swap_maps):
+
+            container_spec = {"name": "test-container", "image": "gitlab.com/group/app:1.0"}
+            result = imageswap.swap_image(container_spec)
+
+        self.assertTrue(result)
+        self.assertEqual(container_spec["image"], "default.example.com/group/app:1.0")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+# Copyright 2020 The WebRoot, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest.mock import patch
+
+sys.path.append("./app/imageswap")
+import config
+
+# Each worker process imports the app with the shared metrics directory set, which
+# has to happen before prometheus_client is imported, so they run in subprocesses.
+WORKER_SCRIPT = """
+import sys
+sys.path.append("./app/imageswap")
+import imageswap
+
+client = imageswap.app.test_client()
+if sys.argv[1] == "post":
+    with open("./testing/pods/test-pod04.json", "rb") as json_file:
+        result = client.post("/", data=json_file.read(), headers={"Content-Type": "application/json"})
+    assert result.status_code == 200
+else:
+    sys.stdout.write(client.get("/metrics").data.decode())
+"""
+
+###########################################################################
+# Test multiprocess metrics ###############################################
+###########################################################################
+
+
+class MultiprocessMetrics(unittest.TestCase):
+    def run_worker(self, metrics_dir, action):
+
+        """Method to run a worker process that shares the metrics directory"""
+
+        env = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=metrics_dir)
+        result = subprocess.run([sys.executable, "-c", WORKER_SCRIPT, action], env=env, capture_output=True, text=True, check=True)
+
+        return result.stdout
+
+    def test_metrics_aggregated_across_workers(self):
+
+        """Method to test a scrape of any worker returns the metrics of every worker"""
+
+        with tempfile.TemporaryDirectory() as metrics_dir:
+
+            self.run_worker(metrics_dir, "post")
+            self.run_worker(metrics_dir, "post")
+            scrape = self.run_worker(metrics_dir, "scrape")
+
+        self.assertIn('imageswap_admission_phase_seconds_count{kind="Pod",outcome="patched",phase="decode"} 2.0', scrape)
+        self.assertIn('imageswap_http_request_total{method="POST",status="200"} 2.0', scrape)
+
+    def test_on_starting_removes_stale_metrics(self):
+
+        """Method to test the gunicorn on_starting hook removes metric files from a previous run"""
+
+        with tempfile.TemporaryDirectory() as metrics_dir:
+
+            # The metric files of a preloaded master (the current process) are kept
+            master_file = f"gauge_max_{os.getpid()}.db"
+
+            for name in ["counter_1.db", "histogram_1.db", "keep.txt", master_file]:
+                open(os.path.join(metrics_dir, name), "w").close()
+
+            with patch("config.prometheus_multiproc_dir", metrics_dir):
+                config.on_starting(None)
+
+            self.assertEqual(sorted(os.listdir(metrics_dir)), sorted(["keep.txt", master_file]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+
+# Copyright 2020 The WebRoot, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import marshal
+import sys
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+sys.path.append("./app/imageswap")
+import imageswap
+import profiling
+
+TOKEN = "s3cr3t"
+
+###########################################################################
+# Test profiling endpoint #################################################
+###########################################################################
+
+
+@patch("profiling.imageswap_profiling_token", TOKEN)
+class ProfilingEndpoint(unittest.TestCase):
+    def setUp(self):
+
+        with open("./testing/pods/test-pod04.json", "rb") as json_file:
+
+            self.request_body = json_file.read()
+
+    def admit(self):
+
+        """Method to post an AdmissionReview to the webhook"""
+
+        result = imageswap.app.test_client().post("/", data=self.request_body, headers={"Content-Type": "application/json"})
+        self.assertEqual(result.status_code, 200)
+
+    def profile(self, query, token=TOKEN):
+
+        """Method to call the profiling endpoint"""
+
+        return imageswap.app.test_client().post(f"/debug/profile?{query}", headers={"Authorization": f"Bearer {token}"})
+
+    def profile_while_admitting(self, query):
+
+        """Method to run a profiling session in the background while posting admissions until it ends"""
+
+        results = []
+        session = threading.Thread(target=lambda: results.append(self.profile(query)))
+        session.start()
+
+        while profiling.active_session is None and session.is_alive():
+            time.sleep(0.001)
+
+        while session.is_alive():
+            self.admit()
+
+        session.join()
+
+        self.assertEqual(results[0].status_code, 200)
+
+        return results[0]
+
+    def test_profiling_disabled_by_default(self):
+
+        """Method to test the profiling endpoint doesn't exist without a token"""
+
+        with patch("profiling.imageswap_profiling_token", ""):
+            self.assertEqual(self.profile("mode=cprofile&seconds=1", token="").status_code, 404)
+
+    def test_profiling_unauthorized(self):
+
+        """Method to test the profiling endpoint requires the token"""
+
+        self.assertEqual(self.profile("mode=cprofile&seconds=1", token="wrong").status_code, 401)
+        self.assertEqual(imageswap.app.test_client().post("/debug/profile").status_code, 401)
+
+    def test_profiling_invalid_parameters(self):
+
+        """Method to test the profiling endpoint rejects invalid parameters"""
+
+        self.assertEqual(self.profile("mode=nope").status_code, 400)
+        self.assertEqual(self.profile("seconds=abc").status_code, 400)
+
+    def test_profiling_cprofile(self):
+
+        """Method to test a cProfile session over a number of admissions"""
+
+        result = self.profile_while_admitting("mode=cprofile&admissions=3&seconds=30")
+
+        self.assertTrue(result.data.startswith(b"# cprofile profile of 3 admissions"))
+        self.assertIn(b"(admit)", result.data)
+
+    def test_profiling_cprofile_concurrent(self):
+
+        """Method to test overlapping admissions in a cProfile session run unprofiled instead of failing"""
+
+        session = profiling.ProfileSession("cprofile", 10, admissions=3)
+        overlap = threading.Barrier(3)
+        results = []
+
+        def admission(value):
+            overlap.wait(timeout=5)
+            return value
+
+        with patch("profiling.active_session", session):
+            threads = [threading.Thread(target=lambda value=value: results.append(profiling.run_admission(admission, value))) for value in range(3)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(sorted(results), [0, 1, 2])
+        self.assertEqual(session.admissions_skipped, 2)
+        self.assertIn(b"# 2 admissions overlapped a profiled admission and ran unprofiled", session.report()[0])
+
+    def test_profiling_cprofile_other_profiler(self):
+
+        """Method to test admissions run unprofiled when another profiling tool is already active"""
+
+        session = profiling.ProfileSession("cprofile", 10)
+
+        with patch("profiling.cProfile.Profile") as profile:
+            profile.return_value.enable.side_effect = ValueError("Another profiling tool is already active")
+            self.assertEqual(session.run(lambda: "admitted"), "admitted")
+
+        self.assertEqual(session.admissions_skipped, 1)
+
+    def test_profiling_cprofile_raw(self):
+
+        """Method to test a cProfile session returned as a raw pstats dump"""
+
+        result = self.profile_while_admitting("mode=cprofile&admissions=1&format=raw")
+        stats = marshal.loads(result.data)
+
+        self.assertIn("admit", [function_name for (_, _, function_name) in stats])
+
+    def test_profiling_sampling(self):
+
+        """Method to test a sampling session returns collapsed stacks of the admissions"""
+
+        result = self.profile_while_admitting("mode=sampling&seconds=0.5")
+        lines = result.data.decode().splitlines()
+
+        self.assertTrue(lines)
+        for line in lines:
+            (stack, count) = line.rsplit(" ", 1)
+            self.assertGreater(int(count), 0)
+        self.assertTrue(any("admit (imageswap.py:" in line for line in lines))
+
+    def test_profiling_memory(self):
+
+        """Method to test a tracemalloc session returns the allocations of the admissions"""
+
+        result = self.profile_while_admitting("mode=memory&admissions=5&top=100")
+
+        self.assertTrue(result.data.startswith(b"# memory profile of 5 admissions"))
+        self.assertIn(b"imageswap.py:", result.data)
+
+    def test_profiling_single_session(self):
+
+        """Method to test only one profiling session can run at a time"""
+
+        with patch("profiling.active_session", profiling.ProfileSession("cprofile", 1)):
+            self.assertEqual(self.profile("mode=cprofile&seconds=1").status_code, 409)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+
+# Copyright 2020 The WebRoot, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest.mock import patch
+
+sys.path.append("./app/imageswap")
+import imageswap_rewrite
+
+DEPLOYMENT = """\
+# Rendered by helm
+apiVersion: apps/v1
+kind: Deployment
+metadata:
+  name: web
+spec:
+  template:
+    spec:
+      initContainers:
+      - name: init
+        image: "busybox:1.33"   # keep this comment
+      containers:
+      - name: web
+        image: nginx:1.21
+      - name: internal
+        image: jmsearcy/internal:1.0
+"""
+
+SERVICE = """\
+---
+apiVersion: v1
+kind: Service
+metadata:
+  name: web
+spec:
+  ports:
+  - port: 80
+"""
+
+###########################################################################
+# Test offline manifest rewriter ##########################################
+###########################################################################
+
+
+@unittest.skipIf(imageswap_rewrite.yaml is None, "PyYAML is not installed")
+@patch("imageswap.imageswap_mode", "MAPS")
+class ManifestRewriter(unittest.TestCase):
+    def rewrite(self, text, output_format="yaml"):
+
+        """Method to rewrite a manifest stream and return the (output, documents, changed documents, errors)"""
+
+        output = io.StringIO()
+        result = imageswap_rewrite.rewrite_stream(io.StringIO(text), output.write, output_format)
+
+        return (output.getvalue(),) + result
+
+    def test_rewrite_yaml_stream(self):
+
+        """Method to test only the image lines of the changed documents in a stream are rewritten"""
+
+        (output, documents, changed, errors) = self.rewrite(DEPLOYMENT + SERVICE)
+
+        self.assertEqual((documents, changed, errors), (2, 1, 0))
+        self.assertEqual(
+            output,
+            DEPLOYMENT.replace('"busybox:1.33"', '"jmsearcy/busybox:1.33"').replace("nginx:1.21", "jmsearcy/nginx:1.21") + SERVICE,
+        )
+
+    def test_rewrite_json(self):
+
+        """Method to test a JSON manifest is rewritten"""
+
+        with open("./testing/pods/test-pod04.json") as json_file:
+            text = json.dumps(json.load(json_file)["request"]["object"], indent=2)
+
+        (output, documents, changed, errors) = self.rewrite(text, "json")
+        pod_spec = json.loads(output)["spec"]
+
+        self.assertEqual((documents, changed, errors), (1, 1, 0))
+        self.assertEqual(pod_spec["containers"][0]["image"], "jmsearcy/paulbouwer/hello-kubernetes:1.5")
+        self.assertEqual(pod_spec["initContainers"][0]["image"], "jmsearcy/paulbouwer/hello-kubernetes:1.5")
+        # The image in the last-applied-configuration annotation is left alone
+        self.assertIn('\\"image\\":\\"paulbouwer/hello-kubernetes:1.5\\"', output)
+
+    def test_rewrite_list(self):
+
+        """Method to test the items of a List are rewritten"""
+
+        text = "apiVersion: v1\nkind: List\nitems:\n- kind: Pod\n  spec:\n    containers:\n    - {name: web, image: nginx}\n"
+
+        (output, documents, changed, errors) = self.rewrite(text)
+
+        self.assertEqual(changed, 1)
+        self.assertIn("{name: web, image: jmsearcy/nginx}", output)
+
+    def test_rewrite_cronjob(self):
+
+        """Method to test the job template of a CronJob is rewritten"""
+
+        text = "kind: CronJob\nspec:\n  jobTemplate:\n    spec:\n      template:\n        spec:\n          containers:\n          - image: nginx\n"
+
+        self.assertIn("- image: jmsearcy/nginx\n", self.rewrite(text)[0])
+
+    def test_rewrite_disabled(self):
+
+        """Method to test workloads with the disable label on the pod template are left alone"""
+
+        text = DEPLOYMENT.replace("    spec:\n", "    metadata:\n      labels:\n        k8s.twr.io/imageswap: disabled\n    spec:\n", 1)
+
+        (output, documents, changed, errors) = self.rewrite(text)
+
+        self.assertEqual(changed, 0)
+        self.assertEqual(output, text)
+
+    def test_rewrite_fallback_dump(self):
+
+        """Method to test documents that can't be rewritten line by line are serialized again"""
+
+        # The same image outside of a container spec would be replaced as well
+        text = DEPLOYMENT.replace("metadata:\n  name: web\n", "metadata:\n  name: web\n  annotations:\n    image: nginx:1.21\n")
+
+        (output, documents, changed, errors) = self.rewrite(text)
+        manifest = imageswap_rewrite.yaml.safe_load(output)
+
+        self.assertEqual(changed, 1)
+        self.assertEqual(manifest["metadata"]["annotations"]["image"], "nginx:1.21")
+        self.assertEqual(manifest["spec"]["template"]["spec"]["containers"][0]["image"], "jmsearcy/nginx:1.21")
+
+    def test_rewrite_invalid_document(self):
+
+        """Method to test documents that can't be parsed (ie. unrendered templates) are passed through"""
+
+        text = "image: {{ .Values.image }}: [\n" + SERVICE
+
+        (output, documents, changed, errors) = self.rewrite(text)
+
+        self.assertEqual((documents, changed, errors), (2, 0, 1))
+        self.assertEqual(output, text)
+
+    def test_rewrite_directory(self):
+
+        """Method to test a directory tree is rewritten in place across a process pool"""
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+
+            os.makedirs(os.path.join(tmp_dir, "apps", ".git"))
+            for name in ["web.yaml", "web2.yml", ".hidden.yaml", ".git/web.yaml"]:
+                with open(os.path.join(tmp_dir, "apps", name), "w") as f:
+                    f.write(DEPLOYMENT)
+            with open(os.path.join(tmp_dir, "service.yaml"), "w") as f:
+                f.write(SERVICE)
+            shutil.copy("./testing/pods/test-pod01.yaml", tmp_dir)
+
+            self.assertEqual(imageswap_rewrite.main(["--check", tmp_dir]), 1)
+            self.assertEqual(imageswap_rewrite.main(["--in-place", "--jobs", "2", tmp_dir]), 0)
+            self.assertEqual(imageswap_rewrite.main(["--check", tmp_dir]), 0)
+
+            with open(os.path.join(tmp_dir, "apps", "web2.yml")) as f:
+                self.assertIn("image: jmsearcy/nginx:1.21\n", f.read())
+            for name in [".hidden.yaml", ".git/web.yaml"]:
+                with open(os.path.join(tmp_dir, "apps", name)) as f:
+                    self.assertEqual(f.read(), DEPLOYMENT)
+            with open(os.path.join(tmp_dir, "service.yaml")) as f:
+                self.assertEqual(f.read(), SERVICE)
+
+
+if __name__ == "__main__":
+    unittest.main()
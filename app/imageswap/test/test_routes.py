@@ -19,6 +19,7 @@ import json
 import os
 import sys
 import unittest
+from prometheus_client import REGISTRY
 from unittest.mock import patch
 
 sys.path.append("./app/imageswap")
@@ -440,6 +441,236 @@ class RoutePatterns(unittest.TestCase):
             self.assertEqual(json.loads(result.data)["response"]["patchType"], "JSONPatch")
             self.assertEqual(json.loads(result.data)["response"]["uid"], "2ca21f3f-a77f-4145-b7ac-bf656a976f46")
 
+    def test_root_pod_swap_many_containers(self):
+
+        """Method to test root route with pod request that has several containers, only some of which should be swapped"""
+
+        with open("./testing/pods/test-pod04.json") as json_file:
+
+            request_object_json = json.load(json_file)
+
+        pod_spec = request_object_json["request"]["object"]["spec"]
+        pod_spec["containers"].append(dict(pod_spec["containers"][0], name="internal", image="jmsearcy/internal:1.0"))
+        pod_spec["containers"].append(dict(pod_spec["containers"][0], name="sidecar", image="quay.io/solo/gloo:v1.0"))
+
+        result = self.app.post(
+            "/",
+            data=json.dumps(request_object_json),
+            headers={"Content-Type": "application/json"},
+        )
+
+        result_patch = json.loads(base64.b64decode(json.loads(result.data)["response"]["patch"]))
+
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(
+            result_patch,
+            [
+                {"op": "replace", "path": "/spec/containers/0/image", "value": "jmsearcy/paulbouwer/hello-kubernetes:1.5"},
+                {"op": "replace", "path": "/spec/containers/2/image", "value": "jmsearcy/solo/gloo:v1.0"},
+                {"op": "replace", "path": "/spec/initContainers/0/image", "value": "jmsearcy/paulbouwer/hello-kubernetes:1.5"},
+            ],
+        )
+
+    def test_root_cronjob_swap_both(self):
+
+        """Method to test root route with cronjob request that should swap the images in the job template"""
+
+        with open("./testing/deployments/test-deploy04.json") as json_file:
+
+            request_object_json = json.load(json_file)
+
+        # Reshape the deployment into a cronjob with the same pod template
+        request = request_object_json["request"]
+        request["kind"] = {"group": "batch", "version": "v1", "kind": "CronJob"}
+        request["object"]["kind"] = "CronJob"
+        request["object"]["spec"] = {"schedule": "*/5 * * * *", "jobTemplate": {"spec": {"template": request["object"]["spec"]["template"]}}}
+
+        result = self.app.post(
+            "/",
+            data=json.dumps(request_object_json),
+            headers={"Content-Type": "application/json"},
+        )
+
+        result_patch = json.loads(base64.b64decode(json.loads(result.data)["response"]["patch"]))
+        pod_spec_path = "/spec/jobTemplate/spec/template/spec"
+
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(
+            result_patch,
+            [
+                {"op": "replace", "path": f"{pod_spec_path}/containers/0/image", "value": "jmsearcy/paulbouwer/hello-kubernetes:1.5"},
+                {"op": "replace", "path": f"{pod_spec_path}/initContainers/0/image", "value": "jmsearcy/paulbouwer/hello-kubernetes:1.5"},
+            ],
+        )
+
+    def test_root_pod_swap_ephemeral(self):
+
+        """Method to test root route with pod request that has an ephemeral container to swap"""
+
+        with open("./testing/pods/test-pod04.json") as json_file:
+
+            request_object_json = json.load(json_file)
+
+        pod_spec = request_object_json["request"]["object"]["spec"]
+        pod_spec["ephemeralContainers"] = [{"name": "debugger", "image": "busybox:1.33", "targetContainerName": pod_spec["containers"][0]["name"]}]
+
+        result = self.app.post(
+            "/",
+            data=json.dumps(request_object_json),
+            headers={"Content-Type": "application/json"},
+        )
+
+        result_patch = json.loads(base64.b64decode(json.loads(result.data)["response"]["patch"]))
+
+        self.assertEqual(result.status_code, 200)
+        self.assertIn({"op": "replace", "path": "/spec/ephemeralContainers/0/image", "value": "jmsearcy/busybox:1.33"}, result_patch)
+
+    def test_locate_containers(self):
+
+        """Method to test the containers of every workload kind are located in one pass"""
+
+        pod_spec = {"containers": [{"image": "a"}, {"image": "b"}], "initContainers": [{"image": "c"}], "ephemeralContainers": [{"image": "d"}]}
+        expected_paths = ["containers/0/image", "containers/1/image", "initContainers/0/image", "ephemeralContainers/0/image"]
+
+        workloads = {
+            "Pod": ({"spec": pod_spec}, "/spec/"),
+            "Deployment": ({"spec": {"template": {"spec": pod_spec}}}, "/spec/template/spec/"),
+            "Job": ({"spec": {"template": {"spec": pod_spec}}}, "/spec/template/spec/"),
+            "CronJob": ({"spec": {"jobTemplate": {"spec": {"template": {"spec": pod_spec}}}}}, "/spec/jobTemplate/spec/template/spec/"),
+        }
+
+        for (kind, (workload_object, prefix)) in workloads.items():
+            with self.subTest(kind=kind):
+                containers = imageswap.locate_containers(workload_object, kind)
+                self.assertEqual([path for (path, _) in containers], [prefix + path for path in expected_paths])
+                self.assertEqual([spec["image"] for (_, spec) in containers], ["a", "b", "c", "d"])
+
+        # A workload without a pod spec has nothing to swap
+        self.assertEqual(imageswap.locate_containers({"spec": {}}, "Deployment"), [])
+
+    def test_root_deploy_swap_disabled_skips_evaluation(self):
+
+        """Method to test root route skips image evaluation entirely when the disable label is used"""
+
+        with open("./testing/deployments/test-deploy05.json") as json_file:
+
+            request_object_json = json.load(json_file)
+
+        with patch("imageswap.evaluate_container") as evaluate_container:
+
+            result = self.app.post(
+                "/",
+                data=json.dumps(request_object_json),
+                headers={"Content-Type": "application/json"},
+            )
+
+        evaluate_container.assert_not_called()
+        self.assertEqual(result.status_code, 200)
+        self.assertNotIn("patch", json.loads(result.data)["response"])
+
+    def test_root_json_backends(self):
+
+        """Method to test root route returns the same response with every JSON backend"""
+
+        with open("./testing/pods/test-pod02.json") as json_file:
+
+            request_object = json_file.read()
+
+        responses = []
+
+        for backend in ["json", "auto"]:
+
+            with patch("imageswap.json_backend", imageswap.load_json_backend(backend)):
+
+                result = self.app.post(
+                    "/",
+                    data=request_object,
+                    headers={"Content-Type": "application/json"},
+                )
+
+            self.assertEqual(result.status_code, 200)
+            self.assertEqual(result.content_type, "application/json")
+            responses.append(json.loads(result.data))
+
+        self.assertEqual(responses[0], responses[1])
+
+    def test_root_invalid_json(self):
+
+        """Method to test root route rejects a request body that isn't valid JSON"""
+
+        result = self.app.post(
+            "/",
+            data="{not json",
+            headers={"Content-Type": "application/json"},
+        )
+
+        self.assertEqual(result.status_code, 400)
+
+    def test_evaluate(self):
+
+        """Method to test evaluate route returns the swapped image and rule for every image in order"""
+
+        images = ["nginx", "quay.io/solo/gloo:v1.0", "jmsearcy/internal:1.0", "nginx"]
+
+        with patch("imageswap.map_image", wraps=imageswap.map_image) as map_image:
+            result = self.app.post(
+                "/v1/evaluate",
+                data=json.dumps({"images": images}),
+                headers={"Content-Type": "application/json"},
+            )
+
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(
+            json.loads(result.data)["images"],
+            [
+                {"image": "nginx", "new_image": "jmsearcy/nginx", "swapped": True, "rule": "default", "map": "default"},
+                {"image": "quay.io/solo/gloo:v1.0", "new_image": "jmsearcy/solo/gloo:v1.0", "swapped": True, "rule": "default", "map": "default"},
+                {"image": "jmsearcy/internal:1.0", "new_image": "jmsearcy/internal:1.0", "swapped": False, "rule": "noswap", "map": "jmsearcy"},
+                {"image": "nginx", "new_image": "jmsearcy/nginx", "swapped": True, "rule": "default", "map": "default"},
+            ],
+        )
+        # Duplicate images are only evaluated once
+        self.assertEqual(map_image.call_count, 3)
+
+    def test_evaluate_invalid(self):
+
+        """Method to test evaluate route rejects requests without a list of images"""
+
+        for data in ["{not json", "{}", '{"images": "nginx"}', '{"images": ["nginx", 1]}', '{"images": [""]}']:
+            with self.subTest(data=data):
+                result = self.app.post("/v1/evaluate", data=data, headers={"Content-Type": "application/json"})
+                self.assertEqual(result.status_code, 400)
+
+    def test_root_phase_metrics(self):
+
+        """Method to test root route records a latency observation for each admission phase"""
+
+        def phase_count(phase, kind, outcome):
+            labels = {"phase": phase, "kind": kind, "outcome": outcome}
+            return REGISTRY.get_sample_value("imageswap_admission_phase_seconds_count", labels) or 0
+
+        phases = ["decode", "maps", "swap", "patch", "encode"]
+
+        with open("./testing/pods/test-pod04.json") as json_file:
+
+            request_object = json_file.read()
+
+        before = {phase: phase_count(phase, "Pod", "patched") for phase in phases}
+
+        result = self.app.post(
+            "/",
+            data=request_object,
+            headers={"Content-Type": "application/json"},
+        )
+
+        self.assertEqual(result.status_code, 200)
+
+        # One observation per phase, except "swap" which is observed per container (1 container + 1 initContainer)
+        for phase in phases:
+            self.assertEqual(phase_count(phase, "Pod", "patched") - before[phase], 2 if phase == "swap" else 1)
+
+        self.assertIn(b"imageswap_admission_phase_seconds_bucket", self.app.get("/metrics").data)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+
+# Copyright 2020 The WebRoot, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Synthetic AdmissionReview and map file corpus used by the ImageSwap benchmarks.
+# Everything is generated from a seed, so runs are reproducible.
+
+import json
+import random
+import uuid
+
+# Image references covering the shapes the swap logic has to handle
+IMAGE_TEMPLATES = [
+    "{name}",
+    "{name}:{tag}",
+    "{org}/{name}:{tag}",
+    "docker.io/{org}/{name}:{tag}",
+    "docker.io/library/{name}:{tag}",
+    "quay.io/{org}/{name}:{tag}",
+    "gcr.io/{org}/{name}:{tag}",
+    "gcr.io:443/{org}/{name}:{tag}",
+    "ghcr.io/{org}/{name}:{tag}",
+    "registry.k8s.io/{name}:{tag}",
+    "registry{index}.example.com/{org}/{name}:{tag}",
+    "registry{index}.example.com:8443/{org}/{name}:{tag}",
+    "harbor.internal.twr.io/{org}/{name}:{tag}",
+    "{org}/{name}@sha256:{digest}",
+]
+
+NAMES = ["nginx", "redis", "envoy", "fluent-bit", "istio-proxy", "postgres", "busybox", "app", "api", "worker", "vault-agent", "otel-collector"]
+ORGS = ["bitnami", "paulbouwer", "istio", "grafana", "team-a", "team-b", "platform", "jmsearcy"]
+
+WORKLOAD_KINDS = {
+    "Pod": ("", "v1", "pods"),
+    "Deployment": ("apps", "v1", "deployments"),
+    "StatefulSet": ("apps", "v1", "statefulsets"),
+    "DaemonSet": ("apps", "v1", "daemonsets"),
+    "ReplicaSet": ("apps", "v1", "replicasets"),
+    "Job": ("batch", "v1", "jobs"),
+}
+
+
+def generate_image(rng, registry_count=100):
+
+    """Function to generate a random image reference"""
+
+    return rng.choice(IMAGE_TEMPLATES).format(
+        name=rng.choice(NAMES),
+        org=rng.choice(ORGS),
+        tag=f"{rng.randint(0, 9)}.{rng.randint(0, 30)}.{rng.randint(0, 9)}",
+        index=rng.randrange(max(registry_count, 1)),
+        digest="%064x" % rng.getrandbits(256),
+    )
+
+
+def generate_container(rng, name, registry_count=100):
+
+    """Function to generate a container spec with the fields the API server fills in"""
+
+    return {
+        "name": name,
+        "image": generate_image(rng, registry_count),
+        "ports": [{"containerPort": 8080, "protocol": "TCP"}],
+        "env": [{"name": f"ENV_{i}", "value": f"value-{i}"} for i in range(rng.randint(0, 10))],
+        "resources": {"limits": {"cpu": "500m", "memory": "256Mi"}, "requests": {"cpu": "50m", "memory": "64Mi"}},
+        "terminationMessagePath": "/dev/termination-log",
+        "terminationMessagePolicy": "File",
+        "imagePullPolicy": "IfNotPresent",
+    }
+
+
+def generate_review(rng, kind="Deployment", containers=2, init_containers=1, annotation_bytes=0, registry_count=100, disabled=False):
+
+    """Function to generate an AdmissionReview request for a workload"""
+
+    (group, version, resource) = WORKLOAD_KINDS[kind]
+    name = f"bench-{rng.choice(NAMES)}-{rng.randrange(100000)}"
+
+    pod_spec = {
+        "containers": [generate_container(rng, f"container-{i}", registry_count) for i in range(containers)],
+        "restartPolicy": "Always",
+        "terminationGracePeriodSeconds": 30,
+        "dnsPolicy": "ClusterFirst",
+        "securityContext": {},
+        "schedulerName": "default-scheduler",
+    }
+    if init_containers:
+        pod_spec["initContainers"] = [generate_container(rng, f"init-{i}", registry_count) for i in range(init_containers)]
+
+    labels = {"app": name}
+    if disabled:
+        labels["k8s.twr.io/imageswap"] = "disabled"
+
+    metadata = {
+        "name": name,
+        "namespace": "bench",
+        "labels": labels,
+        # Large annotations (ie. last-applied-configuration) bloat every request
+        "annotations": {"kubectl.kubernetes.io/last-applied-configuration": "x" * annotation_bytes},
+        "managedFields": [{"manager": "kubectl", "operation": "Update", "apiVersion": f"{group}/{version}".lstrip("/"), "fieldsType": "FieldsV1"}],
+    }
+
+    if kind == "Pod":
+        workload = {"kind": kind, "apiVersion": version, "metadata": metadata, "spec": pod_spec}
+    else:
+        workload = {
+            "kind": kind,
+            "apiVersion": f"{group}/{version}",
+            "metadata": metadata,
+            "spec": {"replicas": 3, "selector": {"matchLabels": labels}, "template": {"metadata": {"labels": labels}, "spec": pod_spec}},
+        }
+
+    return {
+        "kind": "AdmissionReview",
+        "apiVersion": "admission.k8s.io/v1",
+        "request": {
+            "uid": str(uuid.UUID(int=rng.getrandbits(128))),
+            "kind": {"group": group, "version": version, "kind": kind},
+            "resource": {"group": group, "version": version, "resource": resource},
+            "name": name,
+            "namespace": "bench",
+            "operation": "CREATE",
+            "userInfo": {"username": "kubernetes-admin", "groups": ["system:masters", "system:authenticated"]},
+            "object": workload,
+            "oldObject": None,
+            "dryRun": False,
+        },
+    }
+
+
+def generate_corpus(size, seed=0, kinds=("Pod", "Deployment", "StatefulSet"), containers=(1, 12), annotation_bytes=(0, 65536), registry_count=100):
+
+    """Function to generate a list of encoded AdmissionReview request bodies"""
+
+    rng = random.Random(seed)
+    corpus = []
+
+    for _ in range(size):
+        review = generate_review(
+            rng,
+            kind=rng.choice(kinds),
+            containers=rng.randint(*containers),
+            init_containers=rng.randint(0, 2),
+            annotation_bytes=rng.randint(*annotation_bytes),
+            registry_count=registry_count,
+            disabled=rng.random() < 0.05,
+        )
+        corpus.append(json.dumps(review).encode())
+
+    return corpus
+
+
+def generate_map_file(lines, seed=0):
+
+    """Function to generate the contents of a map file with roughly the given number of lines"""
+
+    rng = random.Random(seed)
+    maps = [
+        "# Generated ImageSwap benchmark map file",
+        "default::default.example.com",
+        "docker.io::mirror.example.com/docker-",
+        "docker.io/library::mirror.example.com/library",
+        "quay.io::quay.mirror.example.com",
+        "gcr.io::gcr.mirror.example.com",
+        "cool.io::",
+        "noswap_wildcards::" + ", ".join(["twr.io", "walrus.io"] + [f"internal{i}.corp.example.com" for i in range(max(lines // 20, 1))]),
+    ]
+
+    index = 0
+    while len(maps) < lines:
+        choice = rng.random()
+        if choice < 0.7:
+            maps.append(f"registry{index}.example.com::mirror{index}.example.com")
+        elif choice < 0.8:
+            maps.append(f"registry{index}.example.com:8443::mirror{index}.example.com:30003/registry{index}")
+        elif choice < 0.9:
+            maps.append(f"[EXACT]{rng.choice(ORGS)}/{rng.choice(NAMES)}:{index}::exact.example.com/{rng.choice(NAMES)}:{index}")
+        elif choice < 0.97:
+            maps.append(f"[REPLACE]ghcr.io/{rng.choice(ORGS)}{index}/*::ghcr.mirror.example.com/{index}")
+        else:
+            maps.append(f"# comment {index}")
+        index += 1
+
+    return "\n".join(maps) + "\n"
@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+
+# Copyright 2020 The WebRoot, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Load test for the ImageSwap webhook. Drives a synthetic AdmissionReview corpus
+# through the webhook either in-process (Flask test client) or over HTTP against a
+# local gunicorn server (or an existing server with --url) and reports latency
+# percentiles and throughput.
+#
+# Usage:
+#   testing/benchmarks/loadtest.py --mode inprocess --requests 2000
+#   testing/benchmarks/loadtest.py --mode http --requests 5000 --concurrency 16 --workers 2 --threads 4
+
+import argparse
+import http.client
+import itertools
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import corpus
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+APP_DIR = os.path.join(REPO_ROOT, "app", "imageswap")
+
+################################################################################
+################################################################################
+################################################################################
+
+
+def percentile(sorted_values, pct):
+
+    """Function to return a percentile from a sorted list using linear interpolation"""
+
+    if not sorted_values:
+        return 0.0
+
+    position = (len(sorted_values) - 1) * pct / 100
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+def summarize(latencies, elapsed, errors=0):
+
+    """Function to summarize request latencies (in seconds) into a report"""
+
+    latencies = sorted(latencies)
+
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "max_ms": round(latencies[-1] * 1000, 3) if latencies else 0.0,
+    }
+
+
+################################################################################
+################################################################################
+################################################################################
+
+
+def run_in_process(bodies, requests, map_file, log_level, audit_log_level):
+
+    """Function to drive the webhook in-process through the Flask test client"""
+
+    os.environ["IMAGESWAP_MAPS_FILE"] = map_file
+    os.environ["IMAGESWAP_LOG_LEVEL"] = log_level
+    os.environ["IMAGESWAP_AUDIT_LOG_LEVEL"] = audit_log_level
+    sys.path.insert(0, APP_DIR)
+    import imageswap
+
+    client = imageswap.app.test_client()
+    headers = {"Content-Type": "application/json"}
+    latencies = []
+    errors = 0
+
+    # Warm up the compiled maps before timing
+    client.post("/", data=bodies[0], headers=headers)
+
+    start = time.perf_counter()
+
+    for body in itertools.islice(itertools.cycle(bodies), requests):
+        request_start = time.perf_counter()
+        result = client.post("/", data=body, headers=headers)
+        latencies.append(time.perf_counter() - request_start)
+        if result.status_code != 200:
+            errors += 1
+
+    return summarize(latencies, time.perf_counter() - start, errors)
+
+
+def run_http(bodies, requests, concurrency, url):
+
+    """Function to drive the webhook over HTTP with a pool of keep-alive connections"""
+
+    parsed_url = urllib.parse.urlparse(url)
+    connection_class = http.client.HTTPSConnection if parsed_url.scheme == "https" else http.client.HTTPConnection
+    connection_kwargs = {}
+    if parsed_url.scheme == "https":
+        import ssl
+
+        # The webhook serves a cluster signed cert, which isn't trusted locally
+        connection_kwargs["context"] = ssl._create_unverified_context()
+
+    counter = itertools.count()
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def worker():
+
+        connection = connection_class(parsed_url.hostname, parsed_url.port, timeout=30, **connection_kwargs)
+        local_latencies = []
+        local_errors = 0
+
+        while True:
+            index = next(counter)
+            if index >= requests:
+                break
+            body = bodies[index % len(bodies)]
+            request_start = time.perf_counter()
+            try:
+                connection.request("POST", parsed_url.path or "/", body=body, headers={"Content-Type": "application/json"})
+                response = connection.getresponse()
+                response.read()
+                if response.status != 200:
+                    local_errors += 1
+            except (OSError, http.client.HTTPException):
+                local_errors += 1
+                connection.close()
+                connection = connection_class(parsed_url.hostname, parsed_url.port, timeout=30, **connection_kwargs)
+                continue
+            local_latencies.append(time.perf_counter() - request_start)
+
+        connection.close()
+
+        with lock:
+            latencies.extend(local_latencies)
+            errors.append(local_errors)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return summarize(latencies, time.perf_counter() - start, sum(errors))
+
+
+def free_port():
+
+    """Function to return a free local TCP port"""
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_gunicorn(map_file, port, workers, threads, log_level, audit_log_level):
+
+    """Function to start a local plain HTTP gunicorn server for the webhook and wait for it to be healthy"""
+
+    env = dict(os.environ, IMAGESWAP_MAPS_FILE=map_file, IMAGESWAP_LOG_LEVEL=log_level, IMAGESWAP_AUDIT_LOG_LEVEL=audit_log_level)
+    command = [
+        sys.executable,
+        "-m",
+        "gunicorn",
+        "imageswap:app",
+        f"--bind=127.0.0.1:{port}",
+        f"--workers={workers}",
+        f"--threads={threads}",
+    ]
+    server = subprocess.Popen(command, cwd=APP_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            connection.request("GET", "/healthz")
+            if connection.getresponse().status == 200:
+                return server
+        except OSError:
+            time.sleep(0.1)
+
+    server.terminate()
+    raise RuntimeError("gunicorn did not become healthy within 30s")
+
+
+################################################################################
+################################################################################
+################################################################################
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Load test the ImageSwap webhook with a synthetic AdmissionReview corpus")
+    parser.add_argument("--mode", choices=["inprocess", "http"], default="inprocess")
+    parser.add_argument("--requests", type=int, default=2000, help="number of requests to send")
+    parser.add_argument("--corpus-size", type=int, default=200, help="number of distinct AdmissionReviews to generate")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--kinds", default="Pod,Deployment,StatefulSet", help="comma separated workload kinds")
+    parser.add_argument("--min-containers", type=int, default=1)
+    parser.add_argument("--max-containers", type=int, default=12)
+    parser.add_argument("--max-annotation-kb", type=int, default=64, help="upper bound for the last-applied-configuration annotation size")
+    parser.add_argument("--map-lines", type=int, default=200, help="number of lines in the generated map file")
+    parser.add_argument("--map-file", help="use an existing map file instead of generating one")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent connections in http mode")
+    parser.add_argument("--url", help="target an already running webhook instead of starting gunicorn (http mode)")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn workers in http mode")
+    parser.add_argument("--threads", type=int, default=2, help="gunicorn threads per worker in http mode")
+    parser.add_argument("--log-level", default="WARNING", help="webhook log level")
+    parser.add_argument("--audit-log-level", default="WARNING", help="webhook audit log level (INFO writes one audit record per request)")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    bodies = corpus.generate_corpus(
+        args.corpus_size,
+        seed=args.seed,
+        kinds=tuple(args.kinds.split(",")),
+        containers=(args.min_containers, args.max_containers),
+        annotation_bytes=(0, args.max_annotation_kb * 1024),
+        registry_count=max(args.map_lines, 1),
+    )
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+
+        map_file = args.map_file
+        if map_file is None:
+            map_file = os.path.join(tmp_dir, "imageswap-maps.conf")
+            with open(map_file, "w") as f:
+                f.write(corpus.generate_map_file(args.map_lines, seed=args.seed))
+
+        if args.mode == "inprocess":
+            report = run_in_process(bodies, args.requests, os.path.abspath(map_file), args.log_level, args.audit_log_level)
+        elif args.url:
+            report = run_http(bodies, args.requests, args.concurrency, args.url)
+        else:
+            port = free_port()
+            server = start_gunicorn(os.path.abspath(map_file), port, args.workers, args.threads, args.log_level, args.audit_log_level)
+            try:
+                report = run_http(bodies, args.requests, args.concurrency, f"http://127.0.0.1:{port}/")
+            finally:
+                server.terminate()
+                server.wait()
+
+    report.update(
+        {
+            "mode": args.mode,
+            "corpus_size": args.corpus_size,
+            "avg_request_kb": round(sum(len(body) for body in bodies) / len(bodies) / 1024, 1),
+            "map_lines": args.map_lines,
+            "concurrency": args.concurrency if args.mode == "http" else 1,
+        }
+    )
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for (key, value) in report.items():
+            print(f"{key:>16}: {value}")
+
+    return 1 if report["errors"] else 0
+
+
+if __name__ == "__main__":
+
+    sys.exit(main())
@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+
+# Copyright 2020 The WebRoot, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Microbenchmarks for swap_image() (one per swap branch) and build_swap_map()
+# (map files from 10 to 10,000 lines), with a regression gate against the
+# baseline stored in baseline.json.
+#
+# Every benchmark reports the median of many repeats, which is far less sensitive
+# to a noisy host than the best or the mean. A benchmark that looks regressed is
+# measured again before it is reported, so a single slow moment doesn't fail the gate.
+#
+# Usage:
+#   testing/benchmarks/microbench.py                     # run and print results
+#   testing/benchmarks/microbench.py --check             # fail if a benchmark regressed
+#   testing/benchmarks/microbench.py --update-baseline   # store the results as the new baseline
+
+import argparse
+import contextlib
+import gc
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import timeit
+from unittest.mock import patch
+
+import corpus
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+APP_DIR = os.path.join(REPO_ROOT, "app", "imageswap")
+MAP_FILES_DIR = os.path.join(REPO_ROOT, "testing", "map_files")
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+sys.path.insert(0, APP_DIR)
+import imageswap
+
+# (map file, mode, image) for every branch of swap_image(). The map files are
+# the unit test fixtures, so each image is known to exercise its branch.
+SWAP_IMAGE_CASES = {
+    "exact": ("map_file_exact.conf", "MAPS", "mysql/mysql-server:5.6"),
+    "replace": ("map_file_replace.conf", "MAPS", "nvcr.io/nvidia:k8s-device-plugin_v0.9.0"),
+    "registry": ("map_file.conf", "MAPS", "quay.io/solo/gloo:v1.0"),
+    "registry_port": ("map_file.conf", "MAPS", "registry.bar.com:8443/jmsearcy/twrtools:latest"),
+    "library": ("map_file_library_image.conf", "MAPS", "nginx:latest"),
+    "trailing_dash": ("map_file.conf", "MAPS", "some/random/test/without/registry-or-tag:latest"),
+    "noswap_wildcard": ("map_file.conf", "MAPS", "harbor.geo.k8s.twr.io/stuff/magtape:latest"),
+    "default": ("map_file.conf", "MAPS", "myregistry.com/some/random/test/with/registry:latest"),
+    "empty_map": ("map_file.conf", "MAPS", "cool.io/image:latest"),
+    "legacy": ("map_file.conf", "LEGACY", "paulbouwer/hello-kubernetes:1.5"),
+}
+
+BUILD_SWAP_MAP_LINES = [10, 100, 1000, 10000]
+
+# Benchmarks faster than this are dominated by timer and scheduling noise, so they
+# get a wider threshold (--fast-threshold) than the rest
+FAST_BENCHMARK_NS = 10000
+
+################################################################################
+################################################################################
+################################################################################
+
+
+def time_call(function, repeat, target=0.05):
+
+    """Function to return the (median, relative spread) of the per-call time of a function in nanoseconds
+
+    The number of calls per repeat is scaled so each repeat runs for roughly "target"
+    seconds. The spread is the interquartile range of the repeats relative to the
+    median, which is how noisy the measurement was.
+    """
+
+    # Garbage left by a previous benchmark shouldn't be collected on this one's clock.
+    # The collector stays enabled while timing, as it is when the webhook runs.
+    gc.collect()
+    timer = timeit.Timer(function, setup="gc.enable()")
+    number = 1
+
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= target:
+            break
+        number = max(number * 2, int(number * target / max(elapsed, 1e-9)))
+
+    times = sorted(elapsed / number * 1e9 for elapsed in timer.repeat(repeat=repeat, number=number))
+    (q1, median, q3) = statistics.quantiles(times, n=4) if len(times) > 1 else (times[0],) * 3
+
+    return (median, (q3 - q1) / median)
+
+
+def calibrate(repeat):
+
+    """Function to time a fixed pure Python workload, used to normalize results between machines"""
+
+    def workload():
+        total = 0
+        for i in range(1000):
+            total += len(str(i)) * (i % 7)
+        return {str(i): i for i in range(100)}, total
+
+    return time_call(workload, repeat)[0]
+
+
+def swap_image_benchmark(branch, cached=False):
+
+    """Function to return a context manager that sets up a swap_image() branch and yields the function to time"""
+
+    (map_file, mode, image) = SWAP_IMAGE_CASES[branch]
+    map_file = os.path.join(MAP_FILES_DIR, map_file)
+    container_spec = {"name": "bench", "image": image}
+
+    def run():
+        container_spec["image"] = image
+        imageswap.swap_image(container_spec)
+
+    @contextlib.contextmanager
+    def benchmark():
+        with patch("imageswap.imageswap_mode", mode), patch("imageswap.imageswap_maps_file", map_file), patch.dict(
+            os.environ, {"IMAGE_PREFIX": "jmsearcy"}
+        ), patch.object(imageswap.decision_cache, "maxsize", imageswap.decision_cache.maxsize if cached else 0):
+            # Start from an empty decision cache, so decisions cached by an earlier run aren't
+            # served to the uncached benchmarks. Compile the maps before timing, the map cache
+            # itself is benchmarked separately.
+            imageswap.decision_cache.clear()
+            run()
+            yield run
+
+    return benchmark
+
+
+def map_file_benchmark(function, map_file):
+
+    """Function to return a context manager that yields a map file benchmark"""
+
+    @contextlib.contextmanager
+    def benchmark():
+        yield lambda: function(map_file)
+
+    return benchmark
+
+
+def all_benchmarks(map_dir):
+
+    """Function to return every benchmark by name, writing the generated map files to map_dir"""
+
+    benchmarks = {}
+
+    for branch in SWAP_IMAGE_CASES:
+        benchmarks[f"swap_image/{branch}"] = swap_image_benchmark(branch)
+    for branch in SWAP_IMAGE_CASES:
+        benchmarks[f"swap_image_cached/{branch}"] = swap_image_benchmark(branch, cached=True)
+
+    for lines in BUILD_SWAP_MAP_LINES:
+        map_file = os.path.join(map_dir, f"maps-{lines}.conf")
+        with open(map_file, "w") as f:
+            f.write(corpus.generate_map_file(lines))
+        benchmarks[f"build_swap_map/{lines}"] = map_file_benchmark(imageswap.build_swap_map, map_file)
+        benchmarks[f"compile_swap_map/{lines}"] = map_file_benchmark(imageswap.SwapMaps.from_file, map_file)
+
+    return benchmarks
+
+
+def measure(benchmark, repeat):
+
+    """Function to return the (median, relative spread) of a benchmark"""
+
+    with benchmark() as function:
+        return time_call(function, repeat)
+
+
+def threshold_for(expected, spread, threshold, fast_threshold):
+
+    """Function to return the allowed slowdown for a benchmark
+
+    Benchmarks under 10us get the wider fast threshold, widened further to twice their
+    measured spread (up to 100%), since a few hundred nanoseconds of scheduling noise is
+    a large fraction of their time.
+    """
+
+    if expected >= FAST_BENCHMARK_NS:
+        return threshold
+
+    return min(max(fast_threshold, 2 * spread), 1.0)
+
+
+def compare(results, spreads, baseline, threshold, fast_threshold, remeasure=None, retries=3):
+
+    """Function to compare results against a baseline and return the regressed benchmarks
+
+    Regressed benchmarks are measured again with "remeasure" (which returns the new
+    (value, spread, calibration)) up to "retries" times and only count when every
+    measurement is over the threshold.
+    """
+
+    regressions = []
+
+    for (name, value) in sorted(results.items()):
+        if name == "calibration" or name not in baseline:
+            continue
+
+        # Scale the baseline by how much faster or slower this machine is than the baseline machine
+        expected = baseline[name] * results["calibration"] / baseline["calibration"]
+        allowed = threshold_for(expected, spreads[name], threshold, fast_threshold)
+        change = value / expected - 1
+
+        attempt = 0
+        while change > allowed and remeasure is not None and attempt < retries:
+            attempt += 1
+            (value, spread, calibration) = remeasure(name)
+            expected = baseline[name] * calibration / baseline["calibration"]
+            allowed = threshold_for(expected, spread, threshold, fast_threshold)
+            change = min(change, value / expected - 1)
+
+        status = "REGRESSED" if change > allowed else "ok"
+        print(f"{name:<40} {value:>14,.0f} ns  baseline {expected:>14,.0f} ns  {change:>+8.1%} (allowed {allowed:.0%})  {status}")
+        if change > allowed:
+            regressions.append(name)
+
+    return regressions
+
+
+################################################################################
+################################################################################
+################################################################################
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Microbenchmarks for swap_image() and build_swap_map()")
+    parser.add_argument("--repeat", type=int, default=15, help="timing repeats per benchmark, the median is kept")
+    parser.add_argument("--check", action="store_true", help="compare against the baseline and exit non-zero on regressions")
+    parser.add_argument("--threshold", type=float, default=0.25, help="allowed slowdown versus the baseline (0.25 = 25%%)")
+    parser.add_argument("--fast-threshold", type=float, default=0.5, help="allowed slowdown for benchmarks under 10us, which are noisier (0.5 = 50%%)")
+    parser.add_argument("--update-baseline", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--runs", type=int, default=3, help="full runs whose medians are stored with --update-baseline")
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="baseline file")
+    args = parser.parse_args()
+
+    # Benchmark the swap logic, not the log handlers
+    imageswap.app.logger.setLevel("ERROR")
+
+    with tempfile.TemporaryDirectory() as map_dir:
+
+        benchmarks = all_benchmarks(map_dir)
+
+        # A baseline is kept for a long time, so it is the median of several full runs
+        runs = max(args.runs, 1) if args.update_baseline else 1
+        samples = {name: [] for name in benchmarks}
+        calibrations = [calibrate(args.repeat)]
+        for _ in range(runs):
+            for (name, benchmark) in benchmarks.items():
+                samples[name].append(measure(benchmark, args.repeat))
+            # Calibrate on both sides of every run so a noisy moment doesn't skew the scale
+            calibrations += [calibrate(args.repeat), calibrate(args.repeat)]
+
+        results = {name: statistics.median(value for (value, _) in values) for (name, values) in samples.items()}
+        spreads = {name: statistics.median(spread for (_, spread) in values) for (name, values) in samples.items()}
+        results["calibration"] = statistics.median(calibrations)
+
+        if args.update_baseline:
+            with open(args.baseline, "w") as f:
+                json.dump({name: round(value, 1) for (name, value) in sorted(results.items())}, f, indent=2)
+                f.write("\n")
+            print(f"Baseline written to {args.baseline}")
+
+        if args.check:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+
+            def remeasure(name):
+                # Give a busy moment on the host a chance to pass before measuring again
+                time.sleep(1)
+                calibration = calibrate(args.repeat)
+                (value, spread) = measure(benchmarks[name], args.repeat)
+                return (value, spread, statistics.median([calibration, calibrate(args.repeat), results["calibration"]]))
+
+            regressions = compare(results, spreads, baseline, args.threshold, args.fast_threshold, remeasure)
+            if regressions:
+                print(f"{len(regressions)} benchmark(s) regressed past their threshold: {', '.join(regressions)}")
+                return 1
+            return 0
+
+    if not args.update_baseline:
+        for (name, value) in sorted(results.items()):
+            spread = f"  ±{spreads[name] / 2:.0%}" if name in spreads else ""
+            print(f"{name:<40} {value:>14,.0f} ns{spread}")
+
+    return 0
+
+
+if __name__ == "__main__":
+
+    sys.exit(main())